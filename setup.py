@@ -17,4 +17,13 @@ version_line = list(filter(
 VERSION = eval(version_line.split('=')[-1])
 __version__ = '.'.join([str(x) for x in VERSION])
 
-setup(version=__version__)
\ No newline at end of file
+# Optionally compile the parser with mypyc. The pure Python modules are still
+# installed and used when the compiled ones aren't available.
+ext_modules = []
+if os.environ.get('SHAPESCAPE_DIALOGUE_2_MYPYC', '') == '1':
+    from mypyc.build import mypycify
+    ext_modules = mypycify([
+        os.path.join('src', 'shapescape_dialogue_2', 'parser.py')
+    ])
+
+setup(version=__version__, ext_modules=ext_modules)
\ No newline at end of file
@@ -17,8 +17,9 @@ import scipy.interpolate
 
 from itertools import count
 
-from .message_duration import cpm_duration, sound_duration, wpm_duration
-from .parser import (CameraNode, CoordinatesFacingCoordinates,
+from .message_duration import (cpm_duration, prefetch_sound_durations,
+                               sound_duration, wpm_duration)
+from .parser import (CameraNode, CommandNode, CoordinatesFacingCoordinates,
                      CoordinatesFacingEntity, CoordinatesNode,
                      CoordinatesRotated, DialogueNode, MessageNode,
                      SettingsList, SettingsNode, ProfileNode, var_pattern,
@@ -131,6 +132,14 @@ class ConfigProvider:
             ConfigProvider.parse_settings(settings.settings))
         self.sounds: dict[str, str] = {}
         self.variables: dict[str, str] = {}
+        # The cache of the values of the 'sound' properties resolved to
+        # the paths of the sound files
+        self._resolved_sounds: dict[str, Path] = {}
+        # The cache of parse_settings_cached, the keys are the ids of the
+        # SettingsLists. The SettingsList is stored next to the result to
+        # keep it alive, so its id can't be reused by another object.
+        self._parsed_settings: dict[
+            int, tuple[SettingsList, dict[str, str]]] = {}
         if profile is not None:
             if profile.sounds is not None:
                 self.sounds = ConfigProvider.parse_settings(
@@ -190,6 +199,42 @@ class ConfigProvider:
             settings_dict[setting.name] = setting.value
         return settings_dict
 
+    def parse_settings_cached(self, settings: SettingsList) -> dict[str, str]:
+        '''
+        Same as parse_settings but remembers the results for the settings
+        lists that were already parsed by this ConfigProvider. The AST isn't
+        modified during compilation so the results are always up to date.
+        The returned dictionary is shared and must not be modified.
+        '''
+        try:
+            return self._parsed_settings[id(settings)][1]
+        except KeyError:
+            result = ConfigProvider.parse_settings(settings)
+            self._parsed_settings[id(settings)] = (settings, result)
+            return result
+
+    def prefetch_sound_durations(
+            self, message_nodes: list[MessageNode], rp_path: Path) -> None:
+        '''
+        Reads the durations of the sounds of the message nodes in parallel,
+        so message_node_duration can get them from the cache. Only the nodes
+        which would use the sound duration are checked. The errors in the
+        settings are ignored here, they're reported by message_node_duration.
+        '''
+        sound_paths: list[Path] = []
+        for message_node in message_nodes:
+            try:
+                node_settings = self.parse_settings_cached(
+                    message_node.settings)
+                if ('sound' not in node_settings or 'time' in node_settings
+                        or 'wpm' in node_settings or 'cpm' in node_settings):
+                    continue
+                sound_paths.append(rp_path / self.resolve_sound_path(
+                    node_settings['sound'], message_node))
+            except CompileError:
+                continue
+        prefetch_sound_durations(sound_paths)
+
     def message_node_duration(
             self, message_node: MessageNode, rp_path: Path) -> int:
         '''
@@ -205,13 +250,8 @@ class ConfigProvider:
         - global 'wpm' property
         - global 'cpm' property
         '''
-        # Get the text length for text messages
-        full_text = ""
-        if message_node.node_type != 'blank':
-            full_text = " ".join(
-                node.text for node in message_node.text_nodes)
         # The settings of THIS node
-        node_settings = ConfigProvider.parse_settings(message_node.settings)
+        node_settings = self.parse_settings_cached(message_node.settings)
         # Try using local settings
         if 'time' in node_settings:
             return seconds_to_halfticks(node_settings['time'])
@@ -223,7 +263,8 @@ class ConfigProvider:
             except (ValueError, TypeError):
                 raise CompileError.from_invalid_setting_value(
                     message_node, 'wpm')
-            return seconds_to_halfticks(wpm_duration(full_text, wpm))
+            return seconds_to_halfticks(
+                wpm_duration(message_node_text(message_node), wpm))
         if 'cpm' in node_settings:
             if message_node.node_type == 'blank':
                 raise CompileError.from_invalid_setting(message_node, 'cpm')
@@ -232,7 +273,8 @@ class ConfigProvider:
             except (ValueError, TypeError):
                 raise CompileError.from_invalid_setting_value(
                     message_node, 'cpm')
-            return seconds_to_halfticks(cpm_duration(full_text, cpm))
+            return seconds_to_halfticks(
+                cpm_duration(message_node_text(message_node), cpm))
         if 'sound' in node_settings:
             sound_path = self.resolve_sound_path(
                 node_settings['sound'], message_node)
@@ -242,9 +284,11 @@ class ConfigProvider:
         # 'wpm' and 'cpm' shouldn't give errors from 'blank' message nodes
         # if these properties are implemented in global settings
         if 'wpm' in self.settings and message_node.node_type != 'blank':
-            return seconds_to_halfticks(wpm_duration(full_text, float(self.settings['wpm'])))
+            return seconds_to_halfticks(wpm_duration(
+                message_node_text(message_node), float(self.settings['wpm'])))
         if 'cpm' in self.settings and message_node.node_type != 'blank':
-            return seconds_to_halfticks(cpm_duration(full_text, float(self.settings['cpm'])))
+            return seconds_to_halfticks(cpm_duration(
+                message_node_text(message_node), float(self.settings['cpm'])))
         # TODO - Should I use 'time' property from global settings? Should
         # the local and global settings be converted to a proper type before
         # we reach this point?
@@ -259,7 +303,7 @@ class ConfigProvider:
         sound TimelineEventAction, otherwise it returns None.
         '''
         # The settings of THIS node
-        node_settings = ConfigProvider.parse_settings(message_node.settings)
+        node_settings = self.parse_settings_cached(message_node.settings)
         # Try using local settings
         if 'sound' in node_settings:
             sound_path = self.resolve_sound_path(
@@ -276,6 +320,10 @@ class ConfigProvider:
         property of a message_node. The message_node is used for error
         messages.
         '''
+        try:
+            return self._resolved_sounds[sound]
+        except KeyError:
+            pass
         sound_path: Path
         if ":" in sound:
             sound_variant, sound_name = sound.split(':')
@@ -286,10 +334,20 @@ class ConfigProvider:
                     f"line {message_node.token.line_number}.\n"
                     f"Available variants: "
                     f"{', '.join(self.sounds.keys())}")
-            sound_path = Path(self.sounds[sound_variant]) / sound_name
+            sound_path = cached_path(self.sounds[sound_variant]) / sound_name
         else:
-            sound_path = Path(sound)
-        return Path("sounds") / sound_path
+            sound_path = cached_path(sound)
+        result = Path("sounds") / sound_path
+        self._resolved_sounds[sound] = result
+        return result
+
+# The commands used by the actions that display translated text
+TEXT_ACTION_COMMANDS = {
+    "tell": 'tellraw @a',
+    "title": 'titleraw @a title',
+    "actionbar": 'titleraw @a actionbar',
+    "subtitle": 'titleraw @a subtitle',
+}
 
 @dataclass
 class TimelineEventAction:
@@ -298,6 +356,8 @@ class TimelineEventAction:
     event. Actions are instand and don't have duration. Single timeline event
     can have multiple actions.
     '''
+    __slots__ = ('action_type', 'value', 'line_number')
+
     action_type: Literal["tell", "title", "actionbar", "command", "subtitle", "playsound"]
     value: str
 
@@ -305,6 +365,14 @@ class TimelineEventAction:
     # actions are not created based on a specific line.
     line_number: Optional[int]
 
+    @staticmethod
+    def from_command_node(command_node: CommandNode) -> TimelineEventAction:
+        '''
+        Creates a 'command' TimelineEventAction from a CommandNode.
+        '''
+        return TimelineEventAction(
+            'command', command_node.text, command_node.token.line_number)
+
     def to_command(
             self, tc_provider: TranslationCodeProvider,
             sc_provider: SoundCodeProvider,
@@ -312,42 +380,21 @@ class TimelineEventAction:
         '''
         Returns the command to be executed in Minecraft sequence.
         '''
-        if self.action_type == "tell":
-            resolved_value = config_provider.insert_variables(
-                self.value, self.line_number)
-            translation_code = tc_provider.get_translation_code(resolved_value)
-            return  (
-                'tellraw @a '
-                f'{{"rawtext":[{{"translate":"{translation_code}",'
-                f'"with":["\\n"]}}]}}')
-        elif self.action_type == "title":
-            resolved_value = config_provider.insert_variables(
-                self.value, self.line_number)
-            translation_code = tc_provider.get_translation_code(resolved_value)
-            return  (
-                'titleraw @a title '
-                f'{{"rawtext":[{{"translate":"{translation_code}",'
-                f'"with":["\\n"]}}]}}')
-        elif self.action_type == "actionbar":
-            resolved_value = config_provider.insert_variables(
-                self.value, self.line_number)
-            translation_code = tc_provider.get_translation_code(resolved_value)
-            return  (
-                'titleraw @a actionbar '
-                f'{{"rawtext":[{{"translate":"{translation_code}",'
-                f'"with":["\\n"]}}]}}')
-        elif self.action_type == "subtitle":
+        # The text actions share the same command format, they're looked up
+        # in a dict instead of comparing the action type to each of them
+        text_command = TEXT_ACTION_COMMANDS.get(self.action_type)
+        if text_command is not None:
             resolved_value = config_provider.insert_variables(
                 self.value, self.line_number)
             translation_code = tc_provider.get_translation_code(resolved_value)
             return  (
-                'titleraw @a subtitle '
+                f'{text_command} '
                 f'{{"rawtext":[{{"translate":"{translation_code}",'
                 f'"with":["\\n"]}}]}}')
         elif self.action_type == "command":
             return self.value
         elif self.action_type == "playsound":
-            return f'execute at @a run playsound {sc_provider.get_sound_code(Path(self.value))} @a[r=10000] ~~~ 10000 1 10000'
+            return f'execute at @a run playsound {sc_provider.get_sound_code(cached_path(self.value))} @a[r=10000] ~~~ 10000 1 10000'
         else:
             raise ValueError(f"Unknown action type: {self.action_type}")
 
@@ -356,6 +403,8 @@ class TimelineEvent:
     '''
     Timeline event is a single event that takes place on a timeline.
     '''
+    __slots__ = ('actions',)
+
     actions: list[TimelineEventAction]
 
 @dataclass
@@ -372,10 +421,41 @@ class AnimationTimeline:
     - from a list of events of known length (either a timeline of the root
         node or a time of the camera node)
     - from merging different timelines
+
+    The events are always sorted by time (the keys of the dictionary are
+    inserted in ascending order).
     '''
+    __slots__ = ('events', 'time')
+
     events: dict[int, TimelineEvent]
     time: int
 
+    def emit_commands(
+            self, tc_provider: TranslationCodeProvider,
+            sc_provider: SoundCodeProvider,
+            config_provider: ConfigProvider) -> dict[int, list[str]]:
+        '''
+        Returns the commands of the events of this timeline, sorted by the
+        time of the events (in the same order as the events). The same action
+        object is often used multiple times on the timeline (repeated
+        actionbar messages, loops), such actions are converted to commands
+        only once.
+        '''
+        resolved: dict[int, str] = {}
+        result: dict[int, list[str]] = {}
+        for t, event in self.events.items():
+            commands: list[str] = []
+            for action in event.actions:
+                try:
+                    command = resolved[id(action)]
+                except KeyError:
+                    command = action.to_command(
+                        tc_provider, sc_provider, config_provider)
+                    resolved[id(action)] = command
+                commands.append(command)
+            result[t] = commands
+        return result
+
     @staticmethod
     def from_message_node_list(
             settings: ConfigProvider,
@@ -384,23 +464,22 @@ class AnimationTimeline:
         '''
         Creates a AnimationTimeline from a list of MessageNodes.
         '''
-        events: dict[int, TimelineEvent] = {}
-
-        def add_event_action(
-                time: int, *actions: TimelineEventAction) -> None:
-            if time not in events:
-                events[time] = TimelineEvent(actions=[])
-            events[time].actions.extend(actions)
+        # The actions are collected per time and wrapped into TimelineEvents
+        # at the end
+        timed_actions: defaultdict[int, list[TimelineEventAction]] = (
+            defaultdict(list))
+        command_action = TimelineEventAction.from_command_node
 
         # time is the time of the event on the timeline measured in Minecraft
         # ticks
         time: int = 0
+        settings.prefetch_sound_durations(timeline_nodes, rp_path)
         for node in timeline_nodes:
             duration = settings.message_node_duration(node, rp_path)
             optional_sound_node = settings.try_get_sound_timeline_event_action(
                 node)
             if optional_sound_node is not None:
-                add_event_action(time, optional_sound_node)
+                timed_actions[time].append(optional_sound_node)
             actions: list[TimelineEventAction]
             if node.node_type == 'tell':
                 if len(node.text_nodes) < 1:
@@ -449,29 +528,19 @@ class AnimationTimeline:
                         text_node.token.line_number)
                 loop_time_sum = 0
                 while loop_time_sum < duration:
-                    add_event_action(time + loop_time_sum, action)
+                    timed_actions[time + loop_time_sum].append(action)
                     loop_time_sum += loop_time
                 # Add the last action exactly at the end of the node
-                add_event_action(time + duration, action)
+                timed_actions[time + duration].append(action)
                 # Actions for the commands (must be defined here even though
                 # they are not used here)
                 actions = []
             else:
                 raise ValueError("Unknown MessageNode type")
-            actions += [
-                TimelineEventAction(
-                        'command', text_node.text,
-                        text_node.token.line_number)
-                for text_node in node.command_nodes
-            ]
+            actions += map(command_action, node.command_nodes)
             if node.on_exit_node is not None:
-                on_exit_actions = [
-                    TimelineEventAction(
-                        'command', text_node.text,
-                        text_node.token.line_number)
-                    for text_node in node.on_exit_node.command_nodes
-                ]
-                add_event_action(time + duration, *on_exit_actions)
+                timed_actions[time + duration].extend(
+                    map(command_action, node.on_exit_node.command_nodes))
             if node.run_once_node is not None:
                 run_once_id = f"run_once{next(run_once_counter)}"
                 run_once_actions = [
@@ -484,17 +553,13 @@ class AnimationTimeline:
                 ]
                 run_once_actions.append(TimelineEventAction(
                     'command', f"tag @s add {run_once_id}", None))
-                add_event_action(time, *run_once_actions)
+                timed_actions[time].extend(run_once_actions)
             for schedule_node in node.schedule_nodes:
                 schedule_time = seconds_to_halfticks(  # Should be safe (parser checks that)
-                    ConfigProvider.parse_settings(
+                    settings.parse_settings_cached(
                         schedule_node.settings)['time'])
-                scheduled_actions = [
-                    TimelineEventAction(
-                        'command', text_node.text,
-                        text_node.token.line_number)
-                    for text_node in schedule_node.command_nodes
-                ]
+                scheduled_actions = list(
+                    map(command_action, schedule_node.command_nodes))
                 scheduled_time = (
                     time + schedule_time
                     if schedule_time >= 0 else
@@ -514,27 +579,27 @@ class AnimationTimeline:
                         f"\tLine: {schedule_node.token.line_number}"
                     )
                     
-                add_event_action(scheduled_time, *scheduled_actions)
+                timed_actions[scheduled_time].extend(scheduled_actions)
             for loop_node in node.loop_nodes:
                 loop_time = seconds_to_halfticks(  # This should be safe (parser checks that)
-                    ConfigProvider.parse_settings(
+                    settings.parse_settings_cached(
                         loop_node.settings)['time'])
                 if loop_time <= 0:
                     loop_time = 1  # TODO - should I log a warning?
-                looping_actions = [
-                    TimelineEventAction(
-                        'command', text_node.text,
-                        text_node.token.line_number)
-                    for text_node in loop_node.command_nodes
-                ]
+                looping_actions = list(
+                    map(command_action, loop_node.command_nodes))
                 loop_time_sum = 0
                 while loop_time_sum < duration:
-                    add_event_action(time + loop_time_sum, *looping_actions)
+                    timed_actions[time + loop_time_sum].extend(looping_actions)
                     loop_time_sum += loop_time
-            add_event_action(time, *actions)
+            timed_actions[time].extend(actions)
             time = time + duration
         # Max time is either equal to time or something scheduled for later
-        max_time = max([time] + list(events.keys()))
+        max_time = max([time] + list(timed_actions.keys()))
+        # The scheduled actions can be added out of order, sort the events
+        events = {
+            t: TimelineEvent(actions)
+            for t, actions in sorted(timed_actions.items())}
         return AnimationTimeline(events, max_time)
 
     @staticmethod
@@ -588,6 +653,7 @@ class AnimationTimeline:
             ys, keyframes[0], keyframes[-1], n_frames, spline_fit_degree)
         _, zs = interp1d_magic(
             zs, keyframes[0], keyframes[-1], n_frames, spline_fit_degree)
+        # The frames are in ascending order so the events are sorted
         events: dict[int , TimelineEvent] = {}
         for frame, x, y, z in zip(frames, xs, ys, zs):
             frame = int(frame)
@@ -838,6 +904,28 @@ class AnimationControllerTimeline:
                 raise ValueError(f"Unknown node type: {node}")
         return AnimationControllerTimeline(events)
 
+# The cache used by cached_path
+_path_cache: dict[str, Path] = {}
+
+def cached_path(path: str) -> Path:
+    '''
+    Returns the Path object for given string. The Path objects are cached,
+    the same strings always return the same Path object.
+    '''
+    try:
+        return _path_cache[path]
+    except KeyError:
+        result = Path(path)
+        _path_cache[path] = result
+        return result
+
+def message_node_text(message_node: MessageNode) -> str:
+    '''
+    Returns the full text of a message node (all of its text nodes joined
+    with spaces). Used for calculating the duration of the message.
+    '''
+    return " ".join(node.text for node in message_node.text_nodes)
+
 def seconds_to_halfticks(duration: Union[float, str, int]) -> int:
     '''
     Converts duration in seconds to half-tick count. The values are always
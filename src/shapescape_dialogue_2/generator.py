@@ -5,13 +5,22 @@ Minecraft files.
 from __future__ import annotations
 
 import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import partial
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Any, Optional, Union
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, json module is used without it
+    orjson = None  # type: ignore
 
 from .compiler import (AnimationControllerTimeline, AnimationTimeline,
-                       ConfigProvider, SoundCodeProvider, TimelineEvent,
+                       ConfigProvider, SoundCodeProvider,
                        TranslationCodeProvider, halfticks_to_seconds)
 from .parser import ProfileNode, RootAstNode
 
@@ -31,20 +40,113 @@ def try_load_json_resource(
                 f"'{path.as_posix()}' is not a file. Expected an "
                 f"empty path or a file to save {resource_name} to.")
         try:
+            # orjson.JSONDecodeError is a subclass of JSONDecodeError
+            if orjson is not None:
+                return orjson.loads(path.read_bytes())  # type: ignore
             with open(path, 'r', encoding='utf8') as f:
-                return json.load(f)  # type: ignore
+                return json.load(f)
         except (JSONDecodeError, OSError):
             raise GeneratorError(
                 f"Failed to load '{path.as_posix()}' as JSON file. "
                 f"Expected a valid JSON with an {resource_name}.")
     return None
 
+# Matches the indentation of the lines of the JSON produced by orjson
+ORJSON_INDENT_PATTERN = re.compile(rb'^(?:  )+', re.MULTILINE)
+
+# The buffer size used for the files that are written in many small pieces
+WRITE_BUFFER_SIZE = 1 << 20
+
+def dump_json(
+        path: Path, data: Any, exclusive: bool=False,
+        pretty: bool=False) -> None:
+    '''
+    Saves the data to a compact JSON file or to a JSON file indented with
+    tabs. Uses orjson if it's installed or the json module otherwise.
+
+    :param exclusive: if True, the file is created in the exclusive mode
+        and FileExistsError is raised if it already exists.
+    :param pretty: if True, the JSON is indented with tabs. Minecraft doesn't
+        need the indentation, it's only useful for reading the files.
+    '''
+    dumped: bytes
+    if orjson is not None:
+        if not pretty:
+            dumped = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+        else:
+            # orjson only supports 2-space indentation. JSON strings can't
+            # contain new lines, so the spaces at the start of the lines are
+            # always the indentation and can be safely replaced with tabs.
+            dumped = ORJSON_INDENT_PATTERN.sub(
+                lambda m: b'\t' * (len(m[0]) // 2),
+                orjson.dumps(
+                    data,
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        # json.dump would call write() for every token, dumps() writes once
+        if not pretty:
+            text = json.dumps(
+                data, separators=(',', ':'), ensure_ascii=False)
+        else:
+            text = json.dumps(data, indent='\t', ensure_ascii=False)
+        dumped = text.encode('utf8')
+    with path.open('xb' if exclusive else 'wb') as f:
+        f.write(dumped)
+
+def load_json_resource_cached(
+        path: Path, resource_name: str,
+        default: Callable[[], dict[str, Any]],
+        json_cache: Optional[dict[Path, Any]]) -> dict[str, Any]:
+    '''
+    Gets the content of a JSON resource from the cache, loads it from the
+    path or creates it with the default factory. The result is stored in the
+    cache (if the cache is provided).
+    '''
+    data: Optional[dict[str, Any]]
+    if json_cache is not None and path in json_cache:
+        data = json_cache[path]
+        return data
+    data = try_load_json_resource(path, resource_name)
+    if data is None:
+        data = default()
+    if json_cache is not None:
+        json_cache[path] = data
+    return data
+
+def make_parent_dir(
+        path: Path, created_dirs: Optional[set[Path]] = None) -> None:
+    '''
+    Creates the parent directory of the path (if it doesn't exist).
+
+    :param created_dirs: if provided, the directories from this set are
+        skipped and the created directories are added to it. The set can be
+        shared between the writers to create every directory only once.
+    '''
+    parent = path.parent
+    if created_dirs is not None and parent in created_dirs:
+        return
+    parent.mkdir(parents=True, exist_ok=True)
+    if created_dirs is not None:
+        created_dirs.add(parent)
+
+def flush_json_cache(json_cache: dict[Path, Any], pretty: bool=False) -> None:
+    '''
+    Saves the JSON files collected in the cache by the writers.
+
+    :param pretty: if True, the JSON files are indented (see dump_json).
+    '''
+    for path, data in json_cache.items():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        dump_json(path, data, pretty=pretty)
+
 @dataclass
 class BpacWriter:
     '''
     Writes BPAC files. Can create new ones or overwrite. If existing file
     already has a controller with the same name, it raises an GeneratorError.
     '''
+    __slots__ = ('path', 'short_id', 'data')
+
     path: Path
     '''The path to the BPAC relative to BP/animation_controllers'''
     short_id: str
@@ -52,18 +154,25 @@ class BpacWriter:
     data: dict[str, Any]
     '''The JSON contents of the BPAC'''
 
-    def write(self, bp_path: Path) -> None:
+    def write(
+            self, bp_path: Path,
+            json_cache: Optional[dict[Path, Any]] = None,
+            pretty: bool=False) -> None:
         '''
         Saves the data of the behavior pack animation controller into the file.
+
+        :param json_cache: if provided, the file content is taken from and
+            stored in this cache instead of being saved. The content must be
+            saved later with flush_json_cache.
+        :param pretty: if True, the JSON is indented (see dump_json). Not
+            used when the content is stored in the cache.
         '''
         full_path = bp_path / 'animation_controllers' / self.path
         # Get the existing file data or use the default if it doesn't exist
-        full_file_content = try_load_json_resource(
-            full_path, 'animation controller')
-        if full_file_content is None:
-            full_file_content = {
-                "format_version": "1.17.0", "animation_controllers": {}
-            }
+        full_file_content = load_json_resource_cached(
+            full_path, 'animation controller',
+            lambda: {"format_version": "1.17.0", "animation_controllers": {}},
+            json_cache)
         full_identifier = BpacWriter.get_full_name(self.short_id)
 
         # Try to insert the new controller into the file
@@ -79,9 +188,9 @@ class BpacWriter:
         full_file_content['animation_controllers'][full_identifier] = self.data
 
         # Save the data
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-        with full_path.open('w', encoding='utf8') as f:
-            json.dump(full_file_content, f, indent='\t', ensure_ascii=False)
+        if json_cache is None:
+            full_path.parent.mkdir(parents=True, exist_ok=True)
+            dump_json(full_path, full_file_content, pretty=pretty)
 
     @staticmethod
     def get_full_name(name: str) -> str:
@@ -93,6 +202,8 @@ class BpaWriter:
     A class that represents a behavior pack animation, can save it
     to a file. The internal data doesn't store entire file.
     '''
+    __slots__ = ('path', 'short_id', 'data')
+
     path: Path
     '''The path to the BPA relative to BP/animations'''
     short_id: str
@@ -100,17 +211,25 @@ class BpaWriter:
     data: dict[str, Any]
     '''The JSON content of the animation'''
 
-    def write(self, bp_path: Path) -> None:
+    def write(
+            self, bp_path: Path,
+            json_cache: Optional[dict[Path, Any]] = None,
+            pretty: bool=False) -> None:
         '''
         Saves the data of the behavior pack animation into the file.
+
+        :param json_cache: if provided, the file content is taken from and
+            stored in this cache instead of being saved. The content must be
+            saved later with flush_json_cache.
+        :param pretty: if True, the JSON is indented (see dump_json). Not
+            used when the content is stored in the cache.
         '''
         full_path = bp_path / 'animations' / self.path
         # Get the existing file data or use the default
-        full_file_content = try_load_json_resource(
-            full_path, 'animation')
-        if full_file_content is None:
-            full_file_content = {
-                "format_version": "1.18.0", "animations": {}}
+        full_file_content = load_json_resource_cached(
+            full_path, 'animation',
+            lambda: {"format_version": "1.18.0", "animations": {}},
+            json_cache)
 
         # Try to insert the new controller into the file
         full_identifier = BpaWriter.get_full_name(self.short_id)
@@ -126,9 +245,9 @@ class BpaWriter:
         full_file_content['animations'][full_identifier] = self.data
 
         # Save the data
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-        with full_path.open('w', encoding='utf8') as f:
-            json.dump(full_file_content, f, indent='\t', ensure_ascii=False)
+        if json_cache is None:
+            full_path.parent.mkdir(parents=True, exist_ok=True)
+            dump_json(full_path, full_file_content, pretty=pretty)
 
     @staticmethod
     def get_full_name(name: str) -> str:
@@ -136,6 +255,8 @@ class BpaWriter:
 
 @dataclass
 class LangFileWriter:
+    __slots__ = ('path', 'data')
+
     path: Path
     '''The path to the lang file relative to the RP/texts'''
     data: list[str]
@@ -143,91 +264,138 @@ class LangFileWriter:
 
     def write(self, rp_path: Path) -> None:
         '''Appends the translations to the lang file or creates a new one.'''
-        data = []
         full_path = rp_path / 'texts' /self.path
-        if full_path.exists():
-            with full_path.open('r', encoding='utf8') as f:
-                data.append(f.read())
-        data.extend(self.data)
         full_path.parent.mkdir(parents=True, exist_ok=True)
-        with full_path.open('w', encoding='utf8') as f:
-            f.write('\n'.join(data))
+        with full_path.open(
+                'a', encoding='utf8', buffering=WRITE_BUFFER_SIZE) as f:
+            # The existing translations are separated from the new ones with
+            # a new line (the append mode starts at the end of the file)
+            separator = '\n' if f.tell() > 0 else ''
+            # Stream the lines to the buffered file instead of joining them
+            # into one big string first
+            for line in self.data:
+                f.write(separator)
+                f.write(line)
+                separator = '\n'
 
 @dataclass
 class SoundDefinitionsJsonWriter:
+    __slots__ = ('data',)
+
     data: dict[str, Any]
 
-    def write(self, rp_path: Path) -> None:
+    def write(
+            self, rp_path: Path,
+            json_cache: Optional[dict[Path, Any]] = None,
+            pretty: bool=False) -> None:
+        '''
+        Saves the sound definitions into the sound_definitions.json file.
+
+        :param json_cache: if provided, the file content is taken from and
+            stored in this cache instead of being saved. The content must be
+            saved later with flush_json_cache.
+        :param pretty: if True, the JSON is indented (see dump_json). Not
+            used when the content is stored in the cache.
+        '''
         full_path = rp_path / Path("sounds/sound_definitions.json")
         # Get the existingfile data or use default
-        full_file_content = try_load_json_resource(
-            full_path, '"sound_definitions.json"')
-        if full_file_content is None:
-            full_file_content = {
-                "format_version": "1.14.0", "sound_definitions": {}}
+        full_file_content = load_json_resource_cached(
+            full_path, '"sound_definitions.json"',
+            lambda: {"format_version": "1.14.0", "sound_definitions": {}},
+            json_cache)
         if 'sound_definitions' not in full_file_content:
             raise GeneratorError(
                 f"Missing sound_definitions property in "
                 f"'{full_path.as_posix()}'")
 
         # Try to insert the keys into the file
-        for k, v in self.data.items():
-            if k in full_file_content['sound_definitions']:
-                raise GeneratorError(
-                    f"Sound '{k}' already exists in "
-                    f"'{full_path.as_posix()}'. Unable to overwrite.")
-            full_file_content['sound_definitions'][k] = v
+        sound_definitions = full_file_content['sound_definitions']
+        if not self.data.keys().isdisjoint(sound_definitions):
+            # Report the first duplicate in the order of the new sounds
+            k = next(k for k in self.data if k in sound_definitions)
+            raise GeneratorError(
+                f"Sound '{k}' already exists in "
+                f"'{full_path.as_posix()}'. Unable to overwrite.")
+        sound_definitions.update(self.data)
 
         # Save the data
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-        with full_path.open('w', encoding='utf8') as f:
-            json.dump(full_file_content, f, indent='\t', ensure_ascii=False)
+        if json_cache is None:
+            full_path.parent.mkdir(parents=True, exist_ok=True)
+            dump_json(full_path, full_file_content, pretty=pretty)
 
 @dataclass
 class BpeWriter:
+    __slots__ = ('path', 'data')
+
     path: Path
     '''The path to BPE relative to BP/entities'''
     data: dict[str, Any]
     '''The JSON content of the BPE'''
 
-    def write(self, bp_path: Path) -> None:
+    def write(
+            self, bp_path: Path,
+            created_dirs: Optional[set[Path]] = None,
+            pretty: bool=False) -> None:
         '''
         Tries to write the entity file. If it already exists it throws an
         GeneratorError.
+
+        :param created_dirs: the directories that are known to exist, see
+            make_parent_dir.
+        :param pretty: if True, the JSON is indented (see dump_json).
         '''
-        # Check the file
-        if self.path.exists():
+        full_path = bp_path / 'entities' / self.path
+        make_parent_dir(full_path, created_dirs)
+        # Save the file, the exclusive mode checks if it already exists
+        try:
+            dump_json(full_path, self.data, exclusive=True, pretty=pretty)
+        except FileExistsError:
             raise GeneratorError(
                 f"Unable to generate entity because the file already exists: "
                 f"'{self.path.as_posix()}'")
-        # Save the file
-        full_path = bp_path / 'entities' / self.path
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-        with full_path.open('w', encoding='utf8') as f:
-            json.dump(self.data, f, indent='\t', ensure_ascii=False)
+        except OSError:
+            raise GeneratorError(f"Failed write to '{self.path.as_posix()}'")
+
+# The flags used to create new mcfunction files (O_BINARY exists only on
+# Windows)
+MCFUNCTION_OPEN_FLAGS = (
+    os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0))
 
 @dataclass
 class McfunctionWriter:
+    __slots__ = ('path', 'data')
+
     path: Path
     '''The path to the mcfunction relative to the BP/functions'''
     data: list[str]
     '''The list of the commands to be added to the file'''
 
-    def write(self, bp_path: Path) -> None:
+    def write(
+            self, bp_path: Path,
+            created_dirs: Optional[set[Path]] = None) -> None:
         '''
         Writes the mcfunction file. If it exists raises an GeneratorError.
+
+        :param created_dirs: the directories that are known to exist, see
+            make_parent_dir.
         '''
-        # Check the file
-        if self.path.exists():
+        full_path = bp_path / 'functions' / self.path
+        make_parent_dir(full_path, created_dirs)
+        data = "\n".join(self.data).encode('utf8')
+        # Save the file with unbuffered writes, O_EXCL checks if it already
+        # exists
+        try:
+            fd = os.open(full_path, MCFUNCTION_OPEN_FLAGS, 0o666)
+            try:
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[os.write(fd, view):]
+            finally:
+                os.close(fd)
+        except FileExistsError:
             raise GeneratorError(
                 f"'{self.path.as_posix()}' already exists. Unable to "
                 "overwrite. Expected an empty path to save mcfunction to.")
-        # Save the file
-        full_path = bp_path / 'functions' / self.path
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-        try:
-            with full_path.open('w',encoding='utf8') as f:
-                f.writelines("\n".join(self.data))
         except OSError:
             raise GeneratorError(f"Failed write to '{self.path.as_posix()}'")
 
@@ -239,27 +407,24 @@ class McfunctionGenerator:
     writers: list[McfunctionWriter] = field(default_factory=list)
 
     def add_writer(
-            self, function_id: str, event: TimelineEvent, 
-            context: Context, config_provider: ConfigProvider) -> None:
+            self, function_id: str, commands: list[str]) -> Optional[str]:
+        '''
+        Adds McfunctionWriter with the given commands. If there is only
+        a single command, no writer is added and the command is returned
+        instead, so the caller can run it directly.
+        '''
         # Check the content, the function needs to have at least 1 command
-        len_events = len(event.actions)
-        if len_events == 0:
+        if len(commands) == 0:
             raise GeneratorError(
                 f"Unable to generate the '{function_id} function because "
                 "it contains no commands.")
-
-        # Resolve the commands text
-        commands: list[str] = []
-        for action in event.actions:
-            command = action.to_command(
-                context.tc_provider,
-                context.sc_provider,
-                config_provider)
-            commands.append(command)
+        if len(commands) == 1:
+            return commands[0]
 
         # Append the writer
         function_path = Path(f"{function_id}.mcfunction")
         self.writers.append(McfunctionWriter(function_path, commands))
+        return None
 
 @dataclass
 class BpaGenerator:
@@ -272,11 +437,12 @@ class BpaGenerator:
             self, bpac_state_name: str, state_animation_index: int,
             timeline: AnimationTimeline, context: Context,
             mcfunction_generator: McfunctionGenerator,
-            config_provider: ConfigProvider) -> None:
+            config_provider: ConfigProvider) -> str:
         '''
         Adds BpaWriter (and its mcfunctions), the name of the animation is
         based on the BPAC state that calls this and an index (if there are
-        multiple animations for the same state)
+        multiple animations for the same state). Returns the short ID of the
+        added animation.
         '''
         # shorter_bpa_id: the short ID of animation with the context.subpath
         # stripped
@@ -294,33 +460,43 @@ class BpaGenerator:
         #         "provided animation timeline is empty.")
 
         # Create animation content
+        tc_provider, sc_provider = context.tc_provider, context.sc_provider
+        # The path of the mcfunctions is created once and only extended with
+        # the name of the function inside of the loop
+        subpath_prefix = Path(context.subpath).as_posix()
+        subpath_prefix = '' if subpath_prefix == '.' else f'{subpath_prefix}/'
+        timeline_commands = timeline.emit_commands(
+            tc_provider, sc_provider, config_provider)
+        # The keys of the animation timeline (the times in seconds), converted
+        # lazily in one pass together with the events
+        time_keys = map(str, map(halfticks_to_seconds, timeline_commands))
+        # The timeline is collected into a list and converted to dict at once
+        timeline_entries: list[tuple[str, list[str]]] = []
+        for time_key, (t, commands) in zip(
+                time_keys, timeline_commands.items()):
+            if len(commands) == 0:  # Not accessed for empty timelines
+                continue
+            full_function_id = f'{subpath_prefix}{shorter_bpa_id}_{t}'
+            # The commands are already resolved, they're passed to the
+            # mcfunction generator directly
+            single_command = mcfunction_generator.add_writer(
+                full_function_id, commands)
+            if single_command is not None:
+                timeline_entries.append((time_key, [f"/{single_command}"]))
+            else:
+                timeline_entries.append(
+                    (time_key, [f"/function {full_function_id}"]))
         data: dict[str, Any] = {
             "loop": False,
             "animation_length": halfticks_to_seconds(timeline.time) + 0.1,
-            "timeline": {}
+            "timeline": dict(timeline_entries)
         }
-        sorted_event_keys = sorted(timeline.events.keys())
-        for t in sorted_event_keys:
-            time = halfticks_to_seconds(t)
-            event = timeline.events[t]
-            full_function_id = (
-                Path(context.subpath) / f'{shorter_bpa_id}_{t}').as_posix()
-            if len(event.actions) == 1:
-                command = event.actions[0].to_command(
-                    context.tc_provider,
-                    context.sc_provider,
-                    config_provider)
-                data['timeline'][str(time)] = [f"/{command}"]
-            elif len(event.actions) > 1:   # Not accessed for empty timelines
-                mcfunction_generator.add_writer(
-                    full_function_id, event, context,
-                    config_provider)
-                data['timeline'][str(time)] = [f"/function {full_function_id}"]
 
         # Append the writer
         writer_path = Path(f'{context.subpath}.bpa.json')
         self.writers.append(
             BpaWriter(writer_path, short_bpa_id, data))
+        return short_bpa_id
 
 @dataclass
 class BpacGenerator:
@@ -357,22 +533,19 @@ class BpacGenerator:
                 "end": {"on_entry": ["@s despawn"]}
             }
         }
+        # The names of the states, the last state transitions to "end"
+        state_names = [
+            f'{sound_profile_name}_s{i}' for i in range(len_timeline)]
+        state_names.append("end")
         for i, state in enumerate(timeline.states):
-            state_name = f'{sound_profile_name}_s{i}'
-            if i == len_timeline - 1:
-                next_state = "end"  # Last state
-            else:
-                next_state = f"{sound_profile_name}_s{i + 1}"
+            state_name = state_names[i]
+            next_state = state_names[i + 1]
             animation_names: list[str] = []
             for j, animation_timeline in enumerate(state):
                 # Generate animations
-                bpa_generator.add_writer(
+                animation_names.append(bpa_generator.add_writer(
                     state_name, j, animation_timeline, context,
-                    mcfunction_generator, config_provider)
-                # TODO - This is ugly, getting the name of the animation from
-                # the recently added writer
-                animation_names.append(
-                    bpa_generator.writers[-1].short_id)
+                    mcfunction_generator, config_provider))
             data['states'][state_name] = {
                 "transitions": [
                     {next_state: "q.all_animations_finished"}
@@ -463,32 +636,45 @@ class BpeGenerator:
                 }
             }
         }
-        description = data["minecraft:entity"]["description"]
+        entity = data["minecraft:entity"]
+        description = entity["description"]
         animations = description["animations"]
         scripts_animate = description["scripts"]["animate"]
-        for anim in bpa_generator.writers:
-            # Add to the list of available animations
-            animations[anim.short_id] = BpaWriter.get_full_name(anim.short_id)
-        for i, ac in enumerate(bpac_generator.writers):
-            # Add to the list of available animations
-            animations[f"{ac.short_id}_controller"] = BpacWriter.get_full_name(
-                ac.short_id)
-            # Add to the list of conditionally played animations
-            scripts_animate.append({f"{ac.short_id}_controller": f"q.variant == {i}"})
-            # Add corresponding component groups
-            data['minecraft:entity']['component_groups'][f'{ac.short_id}'] = {
-                "minecraft:variant": {
-                    "value": i
-                }
-            }
-            # Add corresponding events
-            data['minecraft:entity']['events'][f'{ac.short_id}'] = {
-                "add": {
-                    "component_groups": [
-                        f'{ac.short_id}'
-                    ]
-                }
-            }
+        component_groups = entity["component_groups"]
+        events = entity["events"]
+        # The IDs of the controllers and their names used in the entity file
+        controllers = [
+            (ac.short_id, f"{ac.short_id}_controller")
+            for ac in bpac_generator.writers]
+        # Add to the list of available animations (the animations and then
+        # the animation controllers). The names are the same as the ones from
+        # BpaWriter.get_full_name and BpacWriter.get_full_name.
+        animations.update(
+            {
+                anim.short_id: f'animation.{anim.short_id}'
+                for anim in bpa_generator.writers
+            })
+        animations.update(
+            {
+                controller_name: f'controller.animation.{short_id}'
+                for short_id, controller_name in controllers
+            })
+        # Add to the list of conditionally played animations
+        scripts_animate.extend(
+            {controller_name: f"q.variant == {i}"}
+            for i, (_, controller_name) in enumerate(controllers))
+        # Add corresponding component groups
+        component_groups.update(
+            {
+                short_id: {"minecraft:variant": {"value": i}}
+                for i, (short_id, _) in enumerate(controllers)
+            })
+        # Add corresponding events
+        events.update(
+            {
+                short_id: {"add": {"component_groups": [short_id]}}
+                for short_id, _ in controllers
+            })
         # Optional description property for the content guide generator
         if cg_description is not None:
             description['description'] = cg_description
@@ -521,10 +707,77 @@ class Context:
     sc_provider: SoundCodeProvider = field(default_factory=SoundCodeProvider)
     '''The sound code provider.'''
 
-def generate(tree: RootAstNode, context: Context) -> None:
+    pretty: bool = False
+    '''Whether the JSON files should be indented.'''
+
+def write_in_parallel(task_groups: list[list[Callable[[], None]]]) -> None:
+    '''
+    Runs the groups of the writing tasks in a thread pool. The tasks from the
+    same group run one after another, so they can write to the same file.
+    The groups must not write to the same files. If any of the tasks fails,
+    the error is reraised after all of the groups finish.
+    '''
+    def run_group(tasks: list[Callable[[], None]]) -> None:
+        for task in tasks:
+            task()
+
+    task_groups = [group for group in task_groups if len(group) > 0]
+    if len(task_groups) == 0:
+        return
+    # The tasks are I/O bound so there can be more threads than CPUs
+    max_workers = min(32, (os.cpu_count() or 1) * 4, len(task_groups))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(run_group, group) for group in task_groups]
+    for future in futures:
+        future.result()
+
+# The flags used to open the written files and directories for fsync.
+# Windows can only flush the files opened for writing.
+FSYNC_OPEN_FLAGS = os.O_RDWR if os.name == 'nt' else os.O_RDONLY
+
+def fsync_path(path: Path) -> None:
+    '''Flushes the file or directory at the given path to the disk.'''
+    try:
+        fd = os.open(path, FSYNC_OPEN_FLAGS)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        raise GeneratorError(
+            f"Failed to flush '{path.as_posix()}' to the disk")
+
+def fsync_written_paths(
+        written_files: set[Path], pack_paths: list[Path]) -> None:
+    '''
+    Flushes the written files and the directories that contain them to the
+    disk. The directories are synced up to the pack paths, so the entries of
+    the newly created directories are flushed too. Windows can't open
+    directories, so only the files are synced there.
+    '''
+    write_in_parallel([[partial(fsync_path, f)] for f in written_files])
+    if os.name == 'nt':
+        return
+    written_dirs: set[Path] = set()
+    for written_file in written_files:
+        for parent in written_file.parents:
+            if parent in written_dirs:
+                break
+            written_dirs.add(parent)
+            if parent in pack_paths:
+                break
+    write_in_parallel([[partial(fsync_path, d)] for d in written_dirs])
+
+def generate(
+        tree: RootAstNode, context: Context, durable: bool=False) -> None:
     '''
     Generates everything from the given tree and context, and saves it to
     the filesystem.
+
+    :param durable: if True, the written files and their directories are
+        flushed to the disk once at the end. The files are never synced
+        while they're written because they can always be generated again
+        from the source.
     '''
     # The generators
     mcfunction_generator=McfunctionGenerator()
@@ -565,10 +818,9 @@ def generate(tree: RootAstNode, context: Context) -> None:
         generate_bpac_anim_and_mcfunction(
             "default", None)
     # Generate sound_definitions.json
-    sounds_data = {}
     context.sc_provider.inspect_sound_paths(context.rp_path)
-    for k, v in context.sc_provider.walk_names():
-        sounds_data[k] = {
+    sounds_data = {
+        k: {
             "sounds": [
                 {
                     "name": v,
@@ -578,6 +830,8 @@ def generate(tree: RootAstNode, context: Context) -> None:
                 }
             ]
         }
+        for k, v in context.sc_provider.walk_names()
+    }
     sounds_definitions_writer = SoundDefinitionsJsonWriter(sounds_data)
 
     # Generate en_US.lang
@@ -591,14 +845,62 @@ def generate(tree: RootAstNode, context: Context) -> None:
         cg_description=entity_description)
     
     # Write everything to the filesystem
-    for writer in mcfunction_generator.writers:
-        writer.write(context.bp_path)
-    for writer in bpac_generator.writers:
-        writer.write(context.bp_path)
-    for writer in bpa_generator.writers:
-        writer.write(context.bp_path)
-    for writer in bp_entity_generator.writers:
-        writer.write(context.bp_path)
-    sounds_definitions_writer.write(context.rp_path)
-    lang_file_writer.write(context.rp_path)
+    bp_path, rp_path, pretty = context.bp_path, context.rp_path, context.pretty
+    # The animation controllers, animations and sound definitions are merged
+    # into shared files, so they must be written one after another. The files
+    # are loaded and saved only once, the writers only modify the cached
+    # content.
+    # The behavior pack files are written first. The sound definitions and
+    # the lang file can't be restored (the lang file is appended to), so
+    # they're written last and only if all of the behavior pack writers
+    # succeeded. The lang file is written after the sound definitions for
+    # the same reason.
+    bpac_cache: dict[Path, Any] = {}
+    bpac_tasks: list[Callable[[], None]] = [
+        partial(w.write, bp_path, bpac_cache) for w in bpac_generator.writers]
+    bpac_tasks.append(partial(flush_json_cache, bpac_cache, pretty))
+    bpa_cache: dict[Path, Any] = {}
+    bpa_tasks: list[Callable[[], None]] = [
+        partial(w.write, bp_path, bpa_cache) for w in bpa_generator.writers]
+    bpa_tasks.append(partial(flush_json_cache, bpa_cache, pretty))
+    sounds_cache: dict[Path, Any] = {}
+    rp_tasks: list[Callable[[], None]] = [
+        partial(sounds_definitions_writer.write, rp_path, sounds_cache),
+        partial(flush_json_cache, sounds_cache, pretty),
+        partial(lang_file_writer.write, rp_path)]
+    task_groups: list[list[Callable[[], None]]] = [bpac_tasks, bpa_tasks]
+    # Every mcfunction and entity is saved to a separate file. The distinct
+    # directories of these files are created before the writing starts, the
+    # writers get the set of created directories and don't create them again.
+    created_dirs: set[Path] = set()
+    output_dirs = {
+        (bp_path / 'functions' / w.path).parent
+        for w in mcfunction_generator.writers}
+    output_dirs.update(
+        (bp_path / 'entities' / w.path).parent
+        for w in bp_entity_generator.writers)
+    for output_dir in output_dirs:
+        output_dir.mkdir(parents=True, exist_ok=True)
+        created_dirs.add(output_dir)
+    for mcfunction_writer in mcfunction_generator.writers:
+        task_groups.append(
+            [partial(mcfunction_writer.write, bp_path, created_dirs)])
+    for bpe_writer in bp_entity_generator.writers:
+        task_groups.append(
+            [partial(bpe_writer.write, bp_path, created_dirs, pretty)])
+    write_in_parallel(task_groups)
+    # Reached only if none of the behavior pack writers failed
+    for task in rp_tasks:
+        task()
+    if durable:
+        written_files = {
+            *bpac_cache, *bpa_cache, *sounds_cache,
+            rp_path / 'texts' / lang_file_writer.path}
+        written_files.update(
+            bp_path / 'functions' / w.path
+            for w in mcfunction_generator.writers)
+        written_files.update(
+            bp_path / 'entities' / w.path
+            for w in bp_entity_generator.writers)
+        fsync_written_paths(written_files, [bp_path, rp_path])
     # TODO - Return the writers here for easier debugging?
@@ -1,10 +1,61 @@
+import hashlib
+import io
+import os
+import pickle
 import sys
 from pathlib import Path
 from typing import Callable, Optional
 
+from . import __version__
 from .compiler import CompileError
 from .generator import Context, GeneratorError, generate
-from .parser import ParseError, build_ast, tokenize
+from .parser import ParseError, RootAstNode, build_ast, tokenize
+
+# Whether the prettyprinter extras were already installed
+_PP_INSTALLED = False
+
+# The directory with the cached ASTs of the source files
+AST_CACHE_PATH = Path.home() / '.cache' / 'shapescape_dialogue_2'
+
+
+def _ast_cache_file(source: list[str]) -> Path:
+    '''
+    Returns the path to the cache file of the AST of the given source. The
+    name of the file is based on the hash of the source and the version of
+    the package (the AST classes may change between the versions).
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(__version__.encode('utf8'))
+    digest.update(b'\0')
+    digest.update(''.join(source).encode('utf8'))
+    return AST_CACHE_PATH / f'{digest.hexdigest()}.pkl'
+
+def _load_cached_ast(cache_file: Path) -> Optional[RootAstNode]:
+    '''
+    Loads the AST from the cache file or returns None if it's not possible.
+    '''
+    try:
+        with cache_file.open('rb') as f:
+            tree = pickle.load(f)
+    except Exception:  # Missing, corrupted or outdated cache
+        return None
+    return tree if isinstance(tree, RootAstNode) else None
+
+def _save_cached_ast(cache_file: Path, tree: RootAstNode) -> None:
+    '''
+    Saves the AST to the cache file. Failing to save the cache is not an
+    error.
+    '''
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first, so the other processes never
+        # read a partially written cache
+        tmp_file = cache_file.with_suffix(f'.{os.getpid()}.tmp')
+        with tmp_file.open('wb') as f:
+            pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
 
 
 def main(
@@ -15,7 +66,10 @@ def main(
         rp_path: Optional[Path]=None,
         debug_log_tokens: bool=False,
         debug_log_ast: bool=False,
-        debug_skip_packs_output: bool=False) -> None:
+        debug_skip_packs_output: bool=False,
+        pretty_json: bool=False,
+        cache_ast: bool=False,
+        durable: bool=False) -> None:
     # TODO - log_compiled and log_generated
     '''
     :param source_file: the path to the source file with the code that defines
@@ -26,6 +80,11 @@ def main(
     :param rp_path: the output path for the resource files (the resource pack
         folder).
     :param namespace: the namespace to use for the generated entity.
+    :param pretty_json: whether the generated JSON files should be indented.
+    :param cache_ast: whether the AST of the source file should be cached
+        (in AST_CACHE_PATH) and reused when the source doesn't change.
+    :param durable: whether the generated files should be flushed to the
+        disk before returning (see generate()).
     '''
     if bp_path is None or rp_path is None:
         if not debug_skip_packs_output:
@@ -35,34 +94,65 @@ def main(
         bp_path = Path("BP")
         rp_path = Path("RP")
 
-    if debug_log_tokens or debug_log_ast:
-        import prettyprinter
-        prettyprinter.install_extras(
-            include=[
-                'dataclasses',
-            ],
-            warn_on_error=True
-        )
-        # Debug paths
-        log_tokens_path = Path("log_tokens.txt")
-        log_ast_path = Path("log_ast.txt")
-
-    # Read the source
-    with source_file.open("r", encoding='utf8') as f:
-        source = f.readlines()
-
-    # Tokenize
-    tokens = tokenize(source)
-    if debug_log_tokens:
-        with log_tokens_path.open("w", encoding='utf8') as f:
-            for token in tokens:
-                print(token, file=f)
-    
-    # Build the AST
-    tree = build_ast(tokens)
+    # Debug paths
+    log_tokens_path = Path("log_tokens.txt")
+    log_ast_path = Path("log_ast.txt")
+
+    # Try to get the AST from the cache (the tokens aren't cached, so the
+    # cache can't be used when they're logged). The cache needs the whole
+    # source to find the AST.
+    tree: Optional[RootAstNode] = None
+    cache_file: Optional[Path] = None
+    source: list[str] = []
+    if cache_ast and not debug_log_tokens:
+        with source_file.open("r", encoding='utf8') as f:
+            # Read everything at once and split it in memory. The text mode
+            # already normalized the new lines and unlike str.splitlines
+            # StringIO splits only on '\n', like readlines() does.
+            source = io.StringIO(f.read()).readlines()
+        cache_file = _ast_cache_file(source)
+        tree = _load_cached_ast(cache_file)
+
+    if tree is None:
+        # Tokenize, the lines are streamed from the file unless they were
+        # already read for the cache
+        if cache_file is None:
+            with source_file.open("r", encoding='utf8') as f:
+                tokens = tokenize(f)
+        else:
+            tokens = tokenize(source)
+        if debug_log_tokens:
+            with log_tokens_path.open("w", encoding='utf8') as f:
+                f.writelines(f"{token}\n" for token in tokens)
+
+        # Build the AST
+        tree = build_ast(tokens)
+        if cache_file is not None:
+            _save_cached_ast(cache_file, tree)
     if debug_log_ast:
-        with log_ast_path.open("w", encoding='utf8') as f:
-            prettyprinter.pprint(tree, stream=f)
+        # prettyprinter is slow to import and only needed for the AST log.
+        # It's not a dependency of this package, without it the AST is
+        # formatted with the standard library.
+        try:
+            import prettyprinter
+        except ImportError:
+            import pprint
+            with log_ast_path.open("w", encoding='utf8') as f:
+                f.write(pprint.pformat(tree))
+        else:
+            # The extras change global state of prettyprinter, they're
+            # installed only once even if main() runs multiple times
+            global _PP_INSTALLED
+            if not _PP_INSTALLED:
+                prettyprinter.install_extras(
+                    include=[
+                        'dataclasses',
+                    ],
+                    warn_on_error=True
+                )
+                _PP_INSTALLED = True
+            with log_ast_path.open("w", encoding='utf8') as f:
+                prettyprinter.pprint(tree, stream=f)
 
     # Setup the context
     context = Context(
@@ -70,10 +160,11 @@ def main(
         rp_path=rp_path,
         subpath=source_file.stem,
         namespace=namespace,
+        pretty=pretty_json,
     )
     # Generate files
     if not debug_skip_packs_output:
-        generate(tree, context)
+        generate(tree, context, durable=durable)
 
 def main_commandline() -> None:
     '''
@@ -118,6 +209,23 @@ def main_commandline() -> None:
             'The output path for the resource files (the resource pack '
             'folder).')
     )
+    parser.add_argument(
+        '--pretty-json',
+        action='store_true',
+        help='Indent the generated JSON files.'
+    )
+    parser.add_argument(
+        '--cache-ast',
+        action='store_true',
+        help=(
+            'Cache the parsed source file and reuse it when the file '
+            'doesn\'t change.')
+    )
+    parser.add_argument(
+        '--durable',
+        action='store_true',
+        help='Flush the generated files to the disk before exiting.'
+    )
     parser.add_argument(
         '--debug-log-tokens',
         action='store_true',
@@ -154,7 +262,10 @@ def main_commandline() -> None:
         namespace=args.namespace,
         debug_log_tokens=args.debug_log_tokens,
         debug_log_ast=args.debug_log_ast,
-        debug_skip_packs_output=args.debug_skip_packs_output
+        debug_skip_packs_output=args.debug_skip_packs_output,
+        pretty_json=args.pretty_json,
+        cache_ast=args.cache_ast,
+        durable=args.durable
     )
 
     if args.debug_print_stack_traces:
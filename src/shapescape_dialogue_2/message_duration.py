@@ -2,10 +2,19 @@
 The message_duration module provides utilities for getting the duration of an
 animation needed for a text message.
 '''
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Optional
 
-import mutagen
+# The file extensions of the sounds that can have their duration measured
+OGG_SUFFIXES = frozenset({'.ogg', '.oga'})
+# The number of bytes read from the start of the file to find the Vorbis
+# identification header
+OGG_HEADER_READ_SIZE = 512
+# The size of the end of the file searched for the last Ogg page
+OGG_TAIL_SIZE = 65536
 
 
 def cpm_duration(text:str , cpm: float) -> float:
@@ -19,18 +28,97 @@ def wpm_duration(text:str, wpm: float) -> float:
     '''
     Returns duration of reading text based words per minute speed.
     '''
-    length = len(text.split(' '))
+    # The same as len(text.split(' ')) but without creating the list
+    length = text.count(' ') + 1
     return (length*60)/wpm
 
 
 def sound_duration(path: Path) -> Optional[float]:
     '''
     Returns duration of an `.ogg` file. In case of error returns None.
+
+    The results are cached. The modification time of the file is a part of
+    the cache key, so changes to the file are detected.
     '''
+    if path.suffix.lower() not in OGG_SUFFIXES:
+        return None
     try:
-        mutFile = mutagen.File(path)
-    except mutagen.MutagenError:
+        mtime = path.stat().st_mtime
+    except OSError:
         return None
-    if mutFile is not None and type(mutFile) is mutagen.oggvorbis.OggVorbis:
-        return mutFile.info.length  # type: ignore
+    return _probe_sound_duration(str(path), mtime)
+
+def prefetch_sound_durations(paths: Iterable[Path]) -> None:
+    '''
+    Reads the durations of multiple `.ogg` files in parallel. The results
+    are cached, so the following calls of sound_duration for the same files
+    return immediately.
+    '''
+    unique_paths = list(dict.fromkeys(paths))
+    if len(unique_paths) <= 1:
+        return  # Not worth starting the threads
+    with ThreadPoolExecutor(max_workers=min(32, len(unique_paths))) as executor:
+        # sound_duration never raises, the results are stored in the cache
+        for _ in executor.map(sound_duration, unique_paths):
+            pass
+
+@lru_cache(maxsize=4096)
+def _probe_sound_duration(path: str, mtime: float) -> Optional[float]:
+    '''
+    Reads the duration of an `.ogg` file. The mtime is only used as a part
+    of the cache key.
+    '''
+    try:
+        duration = _ogg_duration(path)
+    except OSError:
+        return None
+    if duration is not None:
+        return duration
+    # The fast path can't handle the file, let mutagen figure it out. Only
+    # Ogg Vorbis files are supported so there is no need to detect the type
+    # of the file with mutagen.File.
+    from mutagen import MutagenError
+    from mutagen.oggvorbis import OggVorbis
+    try:
+        return OggVorbis(path).info.length  # type: ignore
+    except (MutagenError, OSError):
+        return None
+
+def _ogg_duration(path: str) -> Optional[float]:
+    '''
+    Reads the duration of an Ogg Vorbis file without parsing the whole file.
+    The sample rate is read from the identification header on the first page
+    and the number of samples from the granule position of the last page of
+    the same stream. Returns None if the file doesn't have this simple
+    layout (e.g. the first page isn't a Vorbis header).
+    '''
+    with open(path, 'rb') as f:
+        head = f.read(OGG_HEADER_READ_SIZE)
+        # The first page: 27 bytes of the header, the segment table, and the
+        # identification packet (7 bytes of signature, 4 bytes of version,
+        # 1 byte of channels and 4 bytes of sample rate)
+        if len(head) < 28 or not head.startswith(b'OggS'):
+            return None
+        packet_start = 27 + head[26]
+        if head[packet_start:packet_start + 7] != b'\x01vorbis':
+            return None
+        serial = head[14:18]
+        sample_rate = int.from_bytes(
+            head[packet_start + 12:packet_start + 16], 'little')
+        if sample_rate == 0:
+            return None
+        # The last page of the stream is somewhere at the end of the file
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - OGG_TAIL_SIZE))
+        tail = f.read()
+    page_start = tail.rfind(b'OggS')
+    while page_start != -1:
+        if page_start + 27 <= len(tail) and tail[page_start + 4] == 0:
+            granule = int.from_bytes(
+                tail[page_start + 6:page_start + 14], 'little', signed=True)
+            page_serial = tail[page_start + 14:page_start + 18]
+            # Pages without finished packets have the granule position -1
+            if page_serial == serial and granule >= 0:
+                return granule / sample_rate
+        page_start = tail.rfind(b'OggS', 0, page_start)
     return None
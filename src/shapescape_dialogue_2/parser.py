@@ -4,10 +4,12 @@ Parser module implements a parser for custom dialogue syntax.
 from __future__ import annotations
 
 import re
-from collections import deque
 from dataclasses import dataclass
-from enum import Enum, auto
-from typing import Any, Callable, Literal, NamedTuple, Optional, Union
+from enum import IntEnum, auto
+from functools import lru_cache
+from types import MappingProxyType
+from typing import (Any, Callable, Iterable, Literal, Mapping, NamedTuple,
+                    Optional, Sequence, Union)
 
 
 class ParseError(Exception):
@@ -24,6 +26,17 @@ class ParseError(Exception):
             "".join(f"\t- {t.descriptive_str()}\n" for t in expected)
         )
 
+    @staticmethod
+    def from_unexpected_block_end(token: Token) -> ParseError:
+        '''
+        Error for a token found where a block should end (with a dedentation
+        or the end of the file).
+        '''
+        return ParseError(
+            f"Unexpected token type {token.token_type} at line "
+            f"{token.line_number}. Expected one of:\n"
+            + BLOCK_END_EXPECTED)
+
     @staticmethod
     def from_unexpected_token_value(
             token: Token, expected: str) -> ParseError:
@@ -39,7 +52,7 @@ class ParseError(Exception):
             f"{token.line_number} and line {duplicate.line_number}."
         )
 
-class TokenType(Enum):
+class TokenType(IntEnum):
     # Fake tokens for indentaiton
     INDENT = auto()
     DEDENT = auto()
@@ -75,70 +88,39 @@ class TokenType(Enum):
     COMMAND = auto()
     TEXT = auto()
 
+    # The token types are integers to make hashing them cheap (they're used
+    # as keys of many dictionaries) but they're printed like normal enums.
+    def __str__(self) -> str:
+        return f"{self.__class__.__name__}.{self.name}"
+
+    def __format__(self, format_spec: str) -> str:
+        return format(str(self), format_spec)
+
     def descriptive_str(self) -> str:
         '''
         Returns descriptive string which can be used for pretty printing in
         error messages.
         '''
-        # Pretty print the labels
-        if self == TokenType.SETTINGS:
-            return '"settings:"'
-        if self == TokenType.TIMELINE:
-            return '"timeline:"'
-        if self == TokenType.ACTOR_PATH:
-            return "actor_path:"
-        if self == TokenType.BLANK:
-            return '"blank:"'
-        if self == TokenType.SCHEDULE:
-            return '"schedule:"'
-        if self == TokenType.ON_EXTI:
-            return '"on_exti:"'
-        if self == TokenType.TELL:
-            return '"tell:"'
-        if self == TokenType.LOOP:
-            return '"loop:"'
-        if self == TokenType.TITLE:
-            return '"title:"'
-        if self == TokenType.ACTIONBAR:
-            return '"actionbar:"'
-        if self == TokenType.DIALOGUE:
-            return '"dialogue:"'
-        if self == TokenType.DIALOGUE_OPTION:
-            return '"dialogue_option:"'
-        if self == TokenType.DIALOGUE_EXIT:
-            return '"dialogue_exit:"'
-        if self == TokenType.CAMERA:
-            return '"camera:"'
-        if self == TokenType.RUN_ONCE:
-            return '"run_once:"'
-        if self == TokenType.ON_EXIT:
-            return '"on_exit:"'
-        # Other tokens
-        if self == TokenType.SETTING:
-            return "setting pair (<name>=<value>)"
-        if self == TokenType.COORDINATES_ROTATED:
-            return "coordinates (<x> <y> <z> [<ry> <rx>])"
-        if self == TokenType.COORDINATES_FACING_COORDINATES:
-            return "coordinates (<x> <y> <z> <facing_x> <facing_y> <facing_z>)"
-        if self == TokenType.COORDINATES_FACING_ENTITY:
-            return "coordinates (<x> <y> <z> facing <entity>)"
-        if self == TokenType.COMMAND:
-            return "command (/<command>)"
-        if self == TokenType.TEXT:
-            return "text (any string)"
-        # Fake tokens
-        if self == TokenType.INDENT:
-            return "indentation"
-        if self == TokenType.DEDENT:
-            return "dedentation"
-        if self == TokenType.EOF:
-            return "end of file"
         # Unimplemented tokens return the string representation
-        return f"{self}"
+        return DESCRIPTIVE_STRINGS.get(self, f"{self}")
+
+# Aliases of the token types compared most often by the parser. Accessing the
+# members of an enum is much slower than reading a global variable.
+_SETTING = TokenType.SETTING
+_INDENT = TokenType.INDENT
+_DEDENT = TokenType.DEDENT
+_EOF = TokenType.EOF
+_TEXT = TokenType.TEXT
+_COMMAND = TokenType.COMMAND
+_NAMED_LABEL = TokenType.NAMED_LABEL
 
 class Token(NamedTuple):
     '''
     Represents a token and it's parsed value
+
+    The type of the value is guaranteed by the tokenizer (strings for
+    labels, text and commands, Setting for settings etc.), so the getters
+    only check it with assertions.
     '''
     token_type: TokenType
     value: Any
@@ -149,10 +131,9 @@ class Token(NamedTuple):
         Validates a token for having 'str' as it's value, and the token type
         TEXT and if it succeeds it returns the 'str' value.
         '''
-        if self.token_type != TokenType.NAMED_LABEL:
+        if self.token_type != _NAMED_LABEL:
             raise ParseError.from_unexpected_token(self, TokenType.NAMED_LABEL)
-        if not isinstance(self.value, str):
-            raise ParseError.from_unexpected_token_value(self, "string")
+        assert isinstance(self.value, str)
         return self.value
 
     def get_str_from_text_token(self) -> str:
@@ -160,10 +141,9 @@ class Token(NamedTuple):
         Validates a token for having 'str' as it's value, and the token type
         TEXT and if it succeeds it returns the 'str' value.
         '''
-        if self.token_type != TokenType.TEXT:
+        if self.token_type != _TEXT:
             raise ParseError.from_unexpected_token(self, TokenType.TEXT)
-        if not isinstance(self.value, str):
-            raise ParseError.from_unexpected_token_value(self, "string")
+        assert isinstance(self.value, str)
         return self.value
 
     def get_setting(self) -> Setting:
@@ -171,15 +151,53 @@ class Token(NamedTuple):
         Validates a token for having Settings as it's value and if it succeeds
         it returns the settings.
         '''
-        if (
-                not isinstance(self.value, Setting) or
-                self.token_type != TokenType.SETTING):
+        if self.token_type != _SETTING:
             raise ParseError(
                 f"Unexpected value of token {self} "
                 f"at line {self.line_number}. Expected setting pair like: "
                 "<key>=<value>")
+        assert isinstance(self.value, Setting)
         return self.value
 
+# Descriptive strings of the token types for the error messages
+DESCRIPTIVE_STRINGS: dict[TokenType, str] = {
+    # Labels
+    TokenType.SETTINGS: '"settings:"',
+    TokenType.TIMELINE: '"timeline:"',
+    TokenType.ACTOR_PATH: "actor_path:",
+    TokenType.BLANK: '"blank:"',
+    TokenType.SCHEDULE: '"schedule:"',
+    TokenType.ON_EXTI: '"on_exti:"',
+    TokenType.TELL: '"tell:"',
+    TokenType.LOOP: '"loop:"',
+    TokenType.TITLE: '"title:"',
+    TokenType.ACTIONBAR: '"actionbar:"',
+    TokenType.DIALOGUE: '"dialogue:"',
+    TokenType.DIALOGUE_OPTION: '"dialogue_option:"',
+    TokenType.DIALOGUE_EXIT: '"dialogue_exit:"',
+    TokenType.CAMERA: '"camera:"',
+    TokenType.RUN_ONCE: '"run_once:"',
+    TokenType.ON_EXIT: '"on_exit:"',
+    # Other tokens
+    TokenType.SETTING: "setting pair (<name>=<value>)",
+    TokenType.COORDINATES_ROTATED: "coordinates (<x> <y> <z> [<ry> <rx>])",
+    TokenType.COORDINATES_FACING_COORDINATES:
+        "coordinates (<x> <y> <z> <facing_x> <facing_y> <facing_z>)",
+    TokenType.COORDINATES_FACING_ENTITY:
+        "coordinates (<x> <y> <z> facing <entity>)",
+    TokenType.COMMAND: "command (/<command>)",
+    TokenType.TEXT: "text (any string)",
+    # Fake tokens
+    TokenType.INDENT: "indentation",
+    TokenType.DEDENT: "dedentation",
+    TokenType.EOF: "end of file",
+}
+
+# The list of the expected tokens of ParseError.from_unexpected_block_end
+BLOCK_END_EXPECTED = (
+    f"\t- {TokenType.DEDENT.descriptive_str()}\n"
+    f"\t- {TokenType.EOF.descriptive_str()}\n")
+
 # Token values
 class Setting(NamedTuple):
     '''A setting of a label'''
@@ -224,21 +242,35 @@ class Indent(NamedTuple):
     @staticmethod
     def of_string(indent_string: str) -> Indent:
         '''Returns an indentation object of a string.'''
-        depth = 0
-        indent_type: Literal['space', 'tab', 'unknown'] = "unknown"
-        if indent_string.startswith('\t'):
-            indent_type = 'tab'
-            while len(indent_string) > depth and indent_string[depth] in '\t ':
-                if indent_string[depth] == ' ':
-                    raise ParseError("Mixed indentation")
-                depth += 1
-        elif indent_string.startswith(' '):
-            indent_type = 'space'
-            while len(indent_string) > depth and indent_string[depth] in '\t ':
-                if indent_string[depth] == '\t':
-                    raise ParseError("Mixed indentation")
-                depth += 1
-        return Indent(depth, indent_type)
+        # Source files use only a few different indentation levels, so the
+        # results are cached by the whitespace prefix of the string.
+        match = LEADING_WHITESPACE_PATTERN.match(indent_string)
+        assert match is not None  # The pattern matches empty strings
+        return _indent_of_prefix(match[0])
+
+LEADING_WHITESPACE_PATTERN = re.compile(r'[\t ]*')
+
+@lru_cache(maxsize=64)
+def _indent_of_prefix(indent_string: str) -> Indent:
+    '''
+    Returns an indentation object of a string that contains only the
+    indentation characters. Used by Indent.of_string.
+    '''
+    depth = 0
+    indent_type: Literal['space', 'tab', 'unknown'] = "unknown"
+    if indent_string.startswith('\t'):
+        indent_type = 'tab'
+        while len(indent_string) > depth and indent_string[depth] in '\t ':
+            if indent_string[depth] == ' ':
+                raise ParseError("Mixed indentation")
+            depth += 1
+    elif indent_string.startswith(' '):
+        indent_type = 'space'
+        while len(indent_string) > depth and indent_string[depth] in '\t ':
+            if indent_string[depth] == '\t':
+                raise ParseError("Mixed indentation")
+            depth += 1
+    return Indent(depth, indent_type)
 
 # Helper patterns for matching common parts of synteax like variables and
 # numbers
@@ -290,122 +322,293 @@ def dequote(matched_string: str) -> str:
     return "".join(result[:-1])
 
 
-TOKENIZER = re.Scanner([  # type: ignore
-    # Ignore blank lines and comments
-    (r'\s+', lambda s, t: None),
-    (r'##.+', lambda s, t: None),
-
-    (r'settings:', lambda s, t: (TokenType.SETTINGS, t)),
-    (r'profiles:', lambda s, t: (TokenType.PROFILES, t)),
-    (r'timeline:', lambda s, t: (TokenType.TIMELINE, t)),
-    (r'actor_path:', lambda s, t: (TokenType.ACTOR_PATH, t)),
-    (r'blank:', lambda s, t: (TokenType.BLANK, t)),
-    (r'schedule:', lambda s, t: (TokenType.SCHEDULE, t)),
-    (r'on_exti:', lambda s, t: (TokenType.ON_EXTI, t)),
-    (r'tell:', lambda s, t: (TokenType.TELL, t)),
-    (r'loop:', lambda s, t: (TokenType.LOOP, t)),
-    (r'title:', lambda s, t: (TokenType.TITLE, t)),
-    (r'actionbar:', lambda s, t: (TokenType.ACTIONBAR, t)),
-    (r'camera:', lambda s, t: (TokenType.CAMERA, t)),
-    (r'run_once:', lambda s, t: (TokenType.RUN_ONCE, t)),
-    (r'on_exit:', lambda s, t: (TokenType.ON_EXIT, t)),
-    (r'dialogue:', lambda s, t: (TokenType.DIALOGUE, t)),
-    (r'dialogue_option:', lambda s, t: (TokenType.DIALOGUE_OPTION, t)),
-    (r'dialogue_exit:', lambda s, t: (TokenType.DIALOGUE_EXIT, t)),
-    (r'sounds:', lambda s, t: (TokenType.SOUNDS, t)),
-    (r'variables:', lambda s, t: (TokenType.VARIABLES, t)),
-    (
-        r'('+var_pattern+')=('+quoted_or_not_pattern+')',
-        lambda s, t: (TokenType.SETTING, Setting(s.match[1], dequote(s.match[2])))
-    ),
-    (
-        f'({float_pattern}) ({float_pattern}) ({float_pattern}) facing'
-            f' ({float_pattern}) ({float_pattern}) ({float_pattern})',
-        lambda s, t: (
+# The type of the functions that create the token values from the matched
+# patterns. They receive the match object and the number of the group of the
+# pattern (the groups of the pattern have the following numbers). The
+# arguments aren't specified because the actions can have additional default
+# arguments that mypy can't infer for lambdas.
+TokenAction = Callable[..., tuple[TokenType, Any]]
+
+def _coordinates_action(
+        match: re.Match[str], group: int) -> tuple[TokenType, Any]:
+    '''
+    The action of the coordinates pattern. All kinds of coordinates share
+    one pattern with alternative endings, the groups of the ending that
+    matched decide the type of the token.
+    '''
+    x = float(match[group + 1])
+    y = float(match[group + 2])
+    z = float(match[group + 3])
+    if match[group + 4] is not None:
+        return (
             TokenType.COORDINATES_FACING_COORDINATES,
             CoordinatesFacingCoordinates(
-                float(s.match[1]), float(s.match[2]), float(s.match[3]),
-                float(s.match[4]), float(s.match[5]), float(s.match[6]),
+                x, y, z, float(match[group + 4]), float(match[group + 5]),
+                float(match[group + 6])
             )
         )
-    ),
-    (
-        f'({float_pattern}) ({float_pattern}) ({float_pattern}) facing'
-            r' (\S+)',
-        lambda s, t: (
+    facing_target = match[group + 7]
+    if facing_target is not None:
+        return (
             TokenType.COORDINATES_FACING_ENTITY,
-            CoordinatesFacingEntity(
-                float(s.match[1]), float(s.match[2]), float(s.match[3]),
-                s.match[4]
-            )
+            CoordinatesFacingEntity(x, y, z, facing_target)
         )
+    return (
+        TokenType.COORDINATES_ROTATED,
+        CoordinatesRotated(
+            x, y, z, float(match[group + 8]), float(match[group + 9]))
+    )
+
+# The patterns of the tokens in the order of their priority (the first pattern
+# that matches is used) and the actions that create the tokens (None means
+# that the matched text is skipped). The token types, value classes and
+# functions used by the actions are bound to the default arguments of the
+# lambdas to avoid global lookups.
+TOKEN_PATTERNS: list[tuple[str, Optional[TokenAction]]] = [
+    # Ignore blank lines and comments
+    (r'\s+', None),
+    (r'##.+', None),
+
+    (r'settings:', lambda m, g, t=TokenType.SETTINGS: (t, m[g])),
+    (r'profiles:', lambda m, g, t=TokenType.PROFILES: (t, m[g])),
+    (r'timeline:', lambda m, g, t=TokenType.TIMELINE: (t, m[g])),
+    (r'actor_path:', lambda m, g, t=TokenType.ACTOR_PATH: (t, m[g])),
+    (r'blank:', lambda m, g, t=TokenType.BLANK: (t, m[g])),
+    (r'schedule:', lambda m, g, t=TokenType.SCHEDULE: (t, m[g])),
+    (r'on_exti:', lambda m, g, t=TokenType.ON_EXTI: (t, m[g])),
+    (r'tell:', lambda m, g, t=TokenType.TELL: (t, m[g])),
+    (r'loop:', lambda m, g, t=TokenType.LOOP: (t, m[g])),
+    (r'title:', lambda m, g, t=TokenType.TITLE: (t, m[g])),
+    (r'actionbar:', lambda m, g, t=TokenType.ACTIONBAR: (t, m[g])),
+    (r'camera:', lambda m, g, t=TokenType.CAMERA: (t, m[g])),
+    (r'run_once:', lambda m, g, t=TokenType.RUN_ONCE: (t, m[g])),
+    (r'on_exit:', lambda m, g, t=TokenType.ON_EXIT: (t, m[g])),
+    (r'dialogue:', lambda m, g, t=TokenType.DIALOGUE: (t, m[g])),
+    (r'dialogue_option:', lambda m, g, t=TokenType.DIALOGUE_OPTION: (t, m[g])),
+    (r'dialogue_exit:', lambda m, g, t=TokenType.DIALOGUE_EXIT: (t, m[g])),
+    (r'sounds:', lambda m, g, t=TokenType.SOUNDS: (t, m[g])),
+    (r'variables:', lambda m, g, t=TokenType.VARIABLES: (t, m[g])),
+    (
+        r'('+var_pattern+')=('+quoted_or_not_pattern+')',
+        lambda m, g, t=TokenType.SETTING, s=Setting, d=dequote: (
+            t, s(m[g + 1], d(m[g + 2])))
     ),
     (
-        f'({float_pattern}) ({float_pattern}) ({float_pattern})'
-            f' ({float_pattern}) ({float_pattern})',
-        lambda s, t: (
-            TokenType.COORDINATES_ROTATED,
-            CoordinatesRotated(
-                float(s.match[1]), float(s.match[2]), float(s.match[3]),
-                float(s.match[4]), float(s.match[5]),
-            )
-        )
+        f'({float_pattern}) ({float_pattern}) ({float_pattern})(?:'
+            f' facing ({float_pattern}) ({float_pattern}) ({float_pattern})'
+            r'| facing (\S+)'
+            f'| ({float_pattern}) ({float_pattern}))',
+        _coordinates_action
+    ),
+    (r'/.+', lambda m, g, t=TokenType.COMMAND: (t, m[g][1:])),
+    (r'>.+', lambda m, g, t=TokenType.TEXT: (t, m[g][1:])),
+    (
+        var_pattern + r':',
+        lambda m, g, t=TokenType.NAMED_LABEL: (t, m[g][:-1])
     ),
-    (r'/.+', lambda s, t: (TokenType.COMMAND, t[1:])),
-    (r'>.+', lambda s, t: (TokenType.TEXT, t[1:])),
-    (var_pattern + r':', lambda s, t: (TokenType.NAMED_LABEL, t[:-1])),
-])
+]
 
-def tokenize(source: list[str]) -> list[Token]:
+def _compile_token_patterns() -> tuple[
+        re.Pattern[str], dict[int, Optional[TokenAction]]]:
+    '''
+    Combines the TOKEN_PATTERNS into a single regular expression. Every
+    pattern is wrapped in a group, the number of the group of the matched
+    pattern is the lastindex of the match (the outer group closes last).
+    Returns the pattern and a dictionary that maps the group numbers to the
+    actions.
     '''
-    Splits a source file into tokens.
+    actions: dict[int, Optional[TokenAction]] = {}
+    group = 1
+    for pattern, action in TOKEN_PATTERNS:
+        actions[group] = action
+        group += re.compile(pattern).groups + 1
+    combined = re.compile(
+        "|".join(f"({pattern})" for pattern, _ in TOKEN_PATTERNS))
+    return combined, actions
+
+TOKEN_PATTERN, TOKEN_ACTIONS = _compile_token_patterns()
+
+# The first characters of the tokens that always take the rest of the line
+# (r'/.+' and r'>.+' patterns). No pattern with higher priority can match
+# text that starts with these characters.
+WHOLE_LINE_TOKENS = {'/': TokenType.COMMAND, '>': TokenType.TEXT}
+
+def tokenize(source: Iterable[str]) -> list[Token]:
     '''
+    Splits a source file into tokens. The source can be any iterable of
+    lines (e.g. an open file), the lines are processed one by one.
+    '''
+    # The line number of the last line, used for the tokens at the end of the
+    # file (stays 0 if the source is empty)
     line_number = 0
     tokens: list[Token] = []
-    indent_stack = deque((0,))
+    # Local references to the class and the methods used in the loop
+    new_token = Token
+    append_token = tokens.append
+    match_token = TOKEN_PATTERN.match
+    # The stack of the indentation depths of the currently open blocks and
+    # the depth of the innermost one
+    indent_stack = [0]
+    current_depth = 0
     indent_type = 'unknown'
-    for line in source:
-        line_number += 1
+    for line_number, line in enumerate(source, 1):
         # Remove the new line characters and other whitespaces from the end of
         # the line if they exists
         line = line.rstrip(" ")
         # Skip empty lines
-        if line.strip() == '':
+        content = line.lstrip()
+        if not content:
             continue
-        # Check the indentation rules
+        # Check the indentation rules (the whitespace prefix is already known
+        # from the lstrip above, there is no need to match it again)
         try:
-            indent = Indent.of_string(line)
+            indent = _indent_of_prefix(line[:len(line) - len(content)])
         except ParseError as e:
             raise ParseError(f"{e} on line {line_number}:\n\n{line}\n")
         if indent_type != 'unknown' and indent_type != indent.indent_type:
             raise ParseError(f"Mixed indentation at line {line_number}:\n\n{line}\n")
         # We don't need the whitespaces in the line anymore, remove them before
         # further processing
-        line = line.lstrip()
+        line = content
         # Insert INDENT or DEDENT tokens if necessary
-        if indent.depth > indent_stack[-1]:
-            indent_stack.append(indent.depth)
-            tokens.append(Token(TokenType.INDENT, None, line_number))
-        elif indent.depth < indent_stack[-1]:
-            while indent.depth < indent_stack[-1]:
+        depth = indent.depth
+        if depth > current_depth:
+            indent_stack.append(depth)
+            current_depth = depth
+            append_token(new_token(TokenType.INDENT, None, line_number))
+        elif depth < current_depth:
+            while depth < current_depth:
                 indent_stack.pop()
-                tokens.append(Token(TokenType.DEDENT, None, line_number))
-            if indent.depth != indent_stack[-1]:
+                current_depth = indent_stack[-1]
+                append_token(new_token(TokenType.DEDENT, None, line_number))
+            if depth != current_depth:
                 raise ParseError(f"Invalid indentation at line {line_number}:\n\n{line}\n")
+        # Fast path for the lines that are a single command or text token.
+        # The patterns of these tokens match everything to the end of the
+        # line so the regular expression isn't needed.
+        line_token_type = WHOLE_LINE_TOKENS.get(line[0])
+        if line_token_type is not None:
+            value, _, rest = line[1:].partition('\n')
+            if value != '' and rest == '':
+                append_token(new_token(line_token_type, value, line_number))
+                continue
         # Tokenize the line
-        tokenized_text, reminder = TOKENIZER.scan(line)
-        if reminder != '':
-            raise ParseError(f"Unable to tokenize line {line_number}:\n\n{line}\n")
-        for token in tokenized_text:
-            tokens.append(Token(token[0], token[1], line_number))
+        pos = 0
+        line_length = len(line)
+        while pos < line_length:
+            match = match_token(line, pos)
+            if match is None or match.end() == pos:
+                raise ParseError(f"Unable to tokenize line {line_number}:\n\n{line}\n")
+            group = match.lastindex
+            assert group is not None  # Every pattern is wrapped in a group
+            action = TOKEN_ACTIONS[group]
+            if action is not None:
+                token_type, value = action(match, group)
+                append_token(new_token(token_type, value, line_number))
+            pos = match.end()
     # Insert DEDENT tokens if necessary
-    while len(indent_stack) > 1:
-        indent_stack.pop()
-        tokens.append(Token(TokenType.DEDENT, None, line_number))
+    tokens.extend(
+        Token(TokenType.DEDENT, None, line_number)
+        for _ in range(len(indent_stack) - 1))
     # Insert EOF token
     tokens.append(Token(TokenType.EOF, None, line_number))
     return tokens
 
+class TokenStream:
+    '''
+    A list of tokens consumed from the front by the AST builder. The tokens
+    aren't removed from the list, the stream only moves its position.
+    '''
+    __slots__ = ('tokens', 'position')
+
+    def __init__(self, tokens: list[Token]) -> None:
+        self.tokens = tokens
+        self.position = 0
+
+    def peek(self) -> Token:
+        '''Returns the next token without consuming it.'''
+        return self.tokens[self.position]
+
+    def pop(self) -> Token:
+        '''Consumes and returns the next token.'''
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def pop_while(self, token_type: TokenType) -> list[Token]:
+        '''
+        Consumes and returns all of the consecutive tokens of given type
+        starting at the current position.
+        '''
+        tokens = self.tokens
+        start = end = self.position
+        # The loop always ends, the last token is EOF
+        while tokens[end].token_type is token_type:
+            end += 1
+        self.position = end
+        return tokens[start:end]
+
+    def pop_block_end(self) -> None:
+        '''
+        Consumes the DEDENT token that ends a block. EOF also ends the block
+        but it's not consumed. Any other token raises a ParseError.
+        '''
+        token = self.tokens[self.position]
+        if token.token_type is _DEDENT:
+            self.position += 1
+        elif token.token_type is not _EOF:
+            raise ParseError.from_unexpected_block_end(token)
+
+# The settings accepted by the labels. Maps the names of the settings to the
+# functions that validate their values (see SettingsNode.parse_settings). The
+# mappings are read-only because they're shared by all of the nodes.
+SettingsSpec = Mapping[str, Callable[[Any], Any]]
+
+SETTINGS_LABEL_SETTINGS: SettingsSpec = MappingProxyType({
+    "wpm": float, "cpm": float, "tp_selector": str, 'description': str})
+BLANK_SETTINGS: SettingsSpec = MappingProxyType({
+    "time": float, "sound": str})
+MESSAGE_SETTINGS: SettingsSpec = MappingProxyType({
+    "wpm": float, "cpm": float, "time": float, "sound": str})
+CAMERA_SETTINGS: SettingsSpec = MappingProxyType({
+    "time": float, "interpolation_mode": int, "tp_selector": str})
+ACTOR_PATH_EXPECTED_SETTINGS: SettingsSpec = MappingProxyType({
+    "tp_selector": str})
+# The accepted and expected settings of the schedule and loop labels
+TIME_SETTINGS: SettingsSpec = MappingProxyType({"time": float})
+
+# The types of the message nodes created from the label tokens
+MESSAGE_NODE_TYPES: dict[
+        TokenType, Literal["tell", "blank", "title", "actionbar"]] = {
+    TokenType.TELL: "tell",
+    TokenType.ACTIONBAR: "actionbar",
+    TokenType.BLANK: "blank",
+    TokenType.TITLE: "title",
+}
+# The types of the tokens that start the message nodes
+MESSAGE_TOKENS = frozenset(MESSAGE_NODE_TYPES)
+
+@lru_cache(maxsize=None)
+def _settings_list_message(setting_names: tuple[str, ...]) -> str:
+    '''
+    Returns the list of the setting names used in the error messages. The
+    same lists are used by many labels, so the results are cached.
+    '''
+    return "\n".join([f"\t-{name}" for name in setting_names])
+
+# The types of the tokens that start the child blocks of the message nodes
+MESSAGE_CHILD_TOKENS = frozenset({
+    TokenType.SCHEDULE, TokenType.RUN_ONCE, TokenType.ON_EXIT,
+    TokenType.LOOP})
+
+# The types of the coordinates tokens (the tuple keeps the order used in the
+# error messages)
+COORDINATES_TOKENS = (
+    TokenType.COORDINATES_ROTATED,
+    TokenType.COORDINATES_FACING_COORDINATES,
+    TokenType.COORDINATES_FACING_ENTITY)
+COORDINATES_TOKEN_SET = frozenset(COORDINATES_TOKENS)
+
 # AST builder
 @dataclass
 class RootAstNode:
@@ -414,34 +617,28 @@ class RootAstNode:
     profiles: Optional[ProfilesNode] = None
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> RootAstNode:
-        token = tokens[0]
+    def from_token_stack(tokens: TokenStream) -> RootAstNode:
+        token = tokens.peek()
         # Settings
         settings = None
         if token.token_type is TokenType.SETTINGS:
             settings = SettingsNode.from_token_stack(tokens)
-            token = tokens[0]
+            token = tokens.peek()
         # Sound profiles
         sound_profiles = None
         if token.token_type is TokenType.PROFILES:
             sound_profiles = ProfilesNode.from_token_stack(tokens)
-            token = tokens[0]
+            token = tokens.peek()
         # Timeline
         timeline: list[Union[MessageNode, DialogueNode, CameraNode]] = []
-        while token.token_type is not TokenType.EOF:
-            if token.token_type in (
-                    TokenType.TELL, TokenType.TITLE, TokenType.ACTIONBAR,
-                    TokenType.BLANK):
-                timeline.append(MessageNode.from_token_stack(tokens))
-            elif token.token_type is TokenType.DIALOGUE:
-                raise NotImplementedError()
-            elif token.token_type is TokenType.CAMERA:
-                timeline.append(CameraNode.from_token_stack(tokens))
-            else:
+        while token.token_type is not _EOF:
+            node_parser = TIMELINE_NODE_PARSERS.get(token.token_type)
+            if node_parser is None:
                 raise ParseError.from_unexpected_token(
                     token, TokenType.TELL, TokenType.BLANK, TokenType.TITLE,
                     TokenType.ACTIONBAR, TokenType.DIALOGUE, TokenType.EOF)
-            token = tokens[0]
+            timeline.append(node_parser(tokens))
+            token = tokens.peek()
         return RootAstNode(timeline, settings, sound_profiles)
 
 @dataclass
@@ -450,25 +647,21 @@ class SettingsNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> SettingsNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> SettingsNode:
+        token = tokens.pop()
         root_token = token
         if token.token_type is not TokenType.SETTINGS:
             raise ParseError.from_unexpected_token(
                 token, TokenType.SETTINGS)
         settings = SettingsNode.parse_settings(
-            tokens,
-            accepted_settings={
-                "wpm": float, "cpm": float, "tp_selector": str,
-                'description': str}
-        )
+            tokens, accepted_settings=SETTINGS_LABEL_SETTINGS)
         return SettingsNode(settings, root_token)
 
     @staticmethod
     def parse_settings(
-            tokens: deque[Token], *,
-            expected_settings: Optional[dict[str, Callable[[Any], Any]]]=None,
-            accepted_settings: Optional[dict[str, Callable[[Any], Any]]]=None
+            tokens: TokenStream, *,
+            expected_settings: Optional[SettingsSpec]=None,
+            accepted_settings: Optional[SettingsSpec]=None
     ) -> SettingsList:
         '''
         Parse settings is a helper function used to parse settings of any
@@ -486,27 +679,24 @@ class SettingsNode:
         type. If callable doesn't fail, the function assumes that the value is
         valid.
         '''
-        token = tokens[0]
+        token = tokens.peek()
         settings: SettingsList = []
         logged_settings: dict[str, SettingNode] = {}
-        while token.token_type is TokenType.SETTING:
+        while token.token_type is _SETTING:
             setting = SettingNode.from_token_stack(tokens)
             # Check accepted settings
             if accepted_settings is not None:
                 # Does key exist?
-                if setting.name not in accepted_settings:
+                converter = accepted_settings.get(setting.name)
+                if converter is None:
                     raise ParseError(
                         f"The '{setting.name}' is not allowed in this "
-                        f"context. Line {token.line_number}. Only following"
-                        "settings are accepted:"
-                        +
-                        "\n".join(
-                            f"\t-{setting}"
-                            for setting in accepted_settings)
-                        )
+                        f"context. Line {token.line_number}. Only following "
+                        "settings are accepted:\n"
+                        + _settings_list_message(tuple(accepted_settings)))
                 # Is the type correct?
                 try:
-                    accepted_settings[setting.name](setting.value)
+                    converter(setting.value)
                 except Exception:
                     raise ParseError(
                         f"The '{setting.name}' has an invalid value. "
@@ -518,7 +708,7 @@ class SettingsNode:
                     f"{setting.token.line_number}")
             logged_settings[setting.name] = setting
             settings.append(setting)
-            token = tokens[0]
+            token = tokens.peek()
         # Check if there are all the expected settings
         if expected_settings is not None:
             for key, func in expected_settings.items():
@@ -549,10 +739,10 @@ class SettingNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> SettingNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> SettingNode:
+        token = tokens.pop()
         root_token = token
-        if token.token_type is not TokenType.SETTING:
+        if token.token_type is not _SETTING:
             raise ParseError.from_unexpected_token(
                 token, TokenType.SETTING)
         name, value = Token.get_setting(token)
@@ -565,29 +755,24 @@ class ProfilesNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> ProfilesNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> ProfilesNode:
+        token = tokens.pop()
         root_token = token
         if token.token_type is not TokenType.PROFILES:
             raise ParseError.from_unexpected_token(
                 token, TokenType.PROFILES)
         # Expect indentation or finish parsing message node
-        token = tokens[0]
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
+        token = tokens.peek()
+        if token.token_type == _INDENT:
+            tokens.pop()
+            token = tokens.peek()
         else:
             return ProfilesNode([], root_token)
         sound_profiles: list[ProfileNode] = []
-        while token.token_type == TokenType.NAMED_LABEL:
+        while token.token_type == _NAMED_LABEL:
             sound_profiles.append(ProfileNode.from_token_stack(tokens))
-            token = tokens[0]
-        # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
-        elif token.token_type is not TokenType.EOF:  # not DEDENT and not EOF
-            raise ParseError.from_unexpected_token(
-                token, TokenType.DEDENT, TokenType.EOF)
+            token = tokens.peek()
+        tokens.pop_block_end()
         return ProfilesNode(sound_profiles, root_token)
 
 @dataclass
@@ -598,16 +783,16 @@ class ProfileNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> ProfileNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> ProfileNode:
+        token = tokens.pop()
         root_token = token
 
         name = token.get_str_from_named_label_token()
         # Expect indentation or finish parsing message node
-        token = tokens[0]
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
+        token = tokens.peek()
+        if token.token_type == _INDENT:
+            tokens.pop()
+            token = tokens.peek()
         else:
             return ProfileNode(name, None, None, root_token)
         sounds: Optional[SoundsNode] = None
@@ -619,20 +804,15 @@ class ProfileNode:
                         f"Duplicate 'sounds' sections in profile '{name}' "
                         f"at line {token.line_number}")
                 sounds = SoundsNode.from_token_stack(tokens)
-                token = tokens[0]
+                token = tokens.peek()
             elif token.token_type is TokenType.VARIABLES:
                 if variables is not None:
                     raise ParseError(
                         f"Duplicate 'variables' sections in profile '{name}' "
                         f"at line {token.line_number}")
                 variables = VariablesNode.from_token_stack(tokens)
-                token = tokens[0]
-        # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
-        elif token.token_type is not TokenType.EOF:  # not DEDENT and not EOF
-            raise ParseError.from_unexpected_token(
-                token, TokenType.DEDENT, TokenType.EOF)
+                token = tokens.peek()
+        tokens.pop_block_end()
         return ProfileNode(name, sounds, variables, root_token)
 
     # def as_dictionary(self) -> dict[str, str]:
@@ -652,14 +832,14 @@ class SoundsNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> SoundsNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> SoundsNode:
+        token = tokens.pop()
         root_token = token
         if token.token_type is not TokenType.SOUNDS:
             raise ParseError.from_unexpected_token(
                 token, TokenType.SOUNDS)
-        token = tokens[0]
-        if token.token_type is not TokenType.SETTING:
+        token = tokens.peek()
+        if token.token_type is not _SETTING:
             raise ParseError.from_unexpected_token(
                 token, TokenType.SETTING)
         settings = SettingsNode.parse_settings(tokens)
@@ -672,14 +852,14 @@ class VariablesNode:
     token: Token
     
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> VariablesNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> VariablesNode:
+        token = tokens.pop()
         root_token = token
         if token.token_type is not TokenType.VARIABLES:
             raise ParseError.from_unexpected_token(
                 token, TokenType.VARIABLES)
-        token = tokens[0]
-        if token.token_type is not TokenType.SETTING:
+        token = tokens.peek()
+        if token.token_type is not _SETTING:
             raise ParseError.from_unexpected_token(
                 token, TokenType.SETTING)
         settings = SettingsNode.parse_settings(tokens)
@@ -698,60 +878,44 @@ class MessageNode:
     on_exit_node: Optional[OnExitNode] = None
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> MessageNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> MessageNode:
+        token = tokens.pop()
         root_token = token
 
-        node_type: Literal["tell", "blank", "title", "actionbar"]
-        if token.token_type is TokenType.TELL:
-            node_type = "tell"
-        elif token.token_type is TokenType.ACTIONBAR:
-            node_type = "actionbar"
-        elif token.token_type is TokenType.BLANK:
-            node_type = "blank"
-        elif token.token_type is TokenType.TITLE:
-            node_type = "title"
-        else:
+        node_type = MESSAGE_NODE_TYPES.get(token.token_type)
+        if node_type is None:
             raise ParseError.from_unexpected_token(
                 token, TokenType.TELL, TokenType.ACTIONBAR, TokenType.BLANK,
                 TokenType.TITLE)
-        token = tokens[0]
+        token = tokens.peek()
         # Settings
         settings: SettingsList = []
-        if token.token_type is TokenType.SETTING:
+        if token.token_type is _SETTING:
             if node_type == "blank":
                 settings = SettingsNode.parse_settings(
-                    tokens,
-                    accepted_settings={"time": float, "sound": str})
+                    tokens, accepted_settings=BLANK_SETTINGS)
             else:
                 settings = SettingsNode.parse_settings(
-                    tokens,
-                    accepted_settings={
-                        "wpm": float, "cpm": float, "time": float,
-                        "sound": str
-                    }
-                )
-            token = tokens[0]
+                    tokens, accepted_settings=MESSAGE_SETTINGS)
+            token = tokens.peek()
         # Expect indentation or finish parsing message node
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
+        if token.token_type == _INDENT:
+            tokens.pop()
+            token = tokens.peek()
         else:
             return MessageNode(node_type, [], [], [], settings, [], root_token)
         # Text nodes
         text_nodes = []
-        token = tokens[0]
-        while token.token_type is TokenType.TEXT:
+        token = tokens.peek()
+        while token.token_type is _TEXT:
             if node_type == "blank":  # Blank node can't have text
                 raise ParseError.from_unexpected_token(
                     token, TokenType.TEXT)
             text_nodes.append(TextNode.from_token_stack(tokens))
-            token = tokens[0]
+            token = tokens.peek()
         # Command nodes
-        command_nodes = []
-        while token.token_type is TokenType.COMMAND:
-            command_nodes.append(CommandNode.from_token_stack(tokens))
-            token =  tokens[0]
+        command_nodes = _drain_commands(tokens)
+        token = tokens.peek()
         # Run once, schedule, and/or exit nodes
         run_once_node: Optional[RunOnceNode] = None
         registered_run_once_token: Optional[Token] = None  # used for errrors
@@ -759,9 +923,7 @@ class MessageNode:
         registered_exit_token: Optional[Token] = None  # used for errors
         schedule_nodes: list[ScheduleNode] = []
         loop_nodes: list[LoopNode] = []
-        while token.token_type in (
-                TokenType.SCHEDULE, TokenType.RUN_ONCE, TokenType.ON_EXIT,
-                TokenType.LOOP):
+        while token.token_type in MESSAGE_CHILD_TOKENS:
             # Run once node
             if token.token_type is TokenType.RUN_ONCE:
                 if registered_run_once_token is not None:
@@ -782,10 +944,10 @@ class MessageNode:
             # Loop nodes
             if token.token_type is TokenType.LOOP:
                 loop_nodes.append(LoopNode.from_token_stack(tokens))
-            token = tokens[0]
+            token = tokens.peek()
         # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
+        if token.token_type is _DEDENT:
+            tokens.pop()
         return MessageNode(
             node_type, text_nodes, command_nodes, schedule_nodes, settings,
             loop_nodes, root_token, run_once_node, on_exit_node)
@@ -799,7 +961,7 @@ class DialogueNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> DialogueNode:
+    def from_token_stack(tokens: TokenStream) -> DialogueNode:
         raise NotImplementedError()
 
 @dataclass
@@ -809,7 +971,7 @@ class DialogueOptionNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> DialogueOptionNode:
+    def from_token_stack(tokens: TokenStream) -> DialogueOptionNode:
         raise NotImplementedError()
 
 @dataclass
@@ -821,40 +983,38 @@ class CameraNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> CameraNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> CameraNode:
+        token = tokens.pop()
         root_token = token
         if token.token_type is not TokenType.CAMERA:
             raise ParseError.from_unexpected_token(
                 token, TokenType.CAMERA)
-        token = tokens[0]
+        token = tokens.peek()
         # Settings
         settings: SettingsList = []
-        if token.token_type is TokenType.SETTING:
+        if token.token_type is _SETTING:
             settings = SettingsNode.parse_settings(
-                tokens, accepted_settings={
-                    "time": float, "interpolation_mode": int,
-                    "tp_selector": str})
-            token = tokens[0]
+                tokens, accepted_settings=CAMERA_SETTINGS)
+            token = tokens.peek()
         # Expect indentation or finish parsing camera node
-        if token.token_type is not TokenType.INDENT:
+        if token.token_type is not _INDENT:
             raise ParseError.from_unexpected_token(
                 token, TokenType.INDENT)
-        tokens.popleft()
+        tokens.pop()
         # Coordinates
         coordinates = CameraNode.parse_coordinates_list(tokens)
-        token = tokens[0]
+        token = tokens.peek()
         # Actor path
         actor_paths: list[ActorPathNode] = []
         while token.token_type is TokenType.ACTOR_PATH:
             actor_paths.append(ActorPathNode.from_token_stack(tokens))
-            token = tokens[0]
+            token = tokens.peek()
         # Timeline
         timeline: Optional[TimelineNode] = None
         if token.token_type is TokenType.TIMELINE:
             timeline = TimelineNode.from_token_stack(tokens)
-        elif token.token_type == TokenType.DEDENT:
-            tokens.popleft()
+        elif token.token_type == _DEDENT:
+            tokens.pop()
         else:
             raise ParseError.from_unexpected_token(
                 token, TokenType.TIMELINE, TokenType.DEDENT,
@@ -863,27 +1023,21 @@ class CameraNode:
             coordinates, settings, actor_paths, timeline, root_token)
 
     @staticmethod
-    def parse_coordinates_list(tokens: deque[Token]) -> list[CoordinatesNode]:
+    def parse_coordinates_list(tokens: TokenStream) -> list[CoordinatesNode]:
         '''
         Parses a code block with list of coordinates and returns a list.
         '''
         # Coordinates
         coordinates = []
-        token = tokens[0]
-        if token.token_type not in (
-                TokenType.COORDINATES_ROTATED,
-                TokenType.COORDINATES_FACING_COORDINATES,
-                TokenType.COORDINATES_FACING_ENTITY):
+        token = tokens.peek()
+        if token.token_type not in COORDINATES_TOKEN_SET:
             raise ParseError.from_unexpected_token(
                 token,
                 TokenType.INDENT, TokenType.COORDINATES_FACING_COORDINATES,
                 TokenType.COORDINATES_FACING_ENTITY)
-        while token.token_type in (
-                TokenType.COORDINATES_ROTATED,
-                TokenType.COORDINATES_FACING_COORDINATES,
-                TokenType.COORDINATES_FACING_ENTITY):
+        while token.token_type in COORDINATES_TOKEN_SET:
             coordinates.append(CoordinatesNode.from_token_stack(tokens))
-            token = tokens[0]
+            token = tokens.peek()
         return coordinates
 
 @dataclass
@@ -893,36 +1047,33 @@ class ActorPathNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> ActorPathNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> ActorPathNode:
+        token = tokens.pop()
         root_token = token
         if token.token_type is not TokenType.ACTOR_PATH:
             raise ParseError.from_unexpected_token(
                 token, TokenType.ACTOR_PATH)
-        token = tokens[0]
+        token = tokens.peek()
         # Settings
         settings: SettingsList = []
-        if token.token_type is TokenType.SETTING:
+        if token.token_type is _SETTING:
             settings = SettingsNode.parse_settings(
                 tokens,
-                accepted_settings={
-                    "time": float,
-                    "interpolation_mode": int,
-                    "tp_selector": str},
-                expected_settings={"tp_selector": str}
+                accepted_settings=CAMERA_SETTINGS,
+                expected_settings=ACTOR_PATH_EXPECTED_SETTINGS
             )
-            token = tokens[0]
+            token = tokens.peek()
         # Expect indentation or finish parsing actor path node
-        if token.token_type is not TokenType.INDENT:
+        if token.token_type is not _INDENT:
             raise ParseError.from_unexpected_token(
                 token, TokenType.INDENT)
-        tokens.popleft()
+        tokens.pop()
         # Coordinates
         coordinates = CameraNode.parse_coordinates_list(tokens)
-        token = tokens[0]
+        token = tokens.peek()
         # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
+        if token.token_type is _DEDENT:
+            tokens.pop()
         return ActorPathNode(coordinates, settings, root_token)
 
 @dataclass
@@ -931,37 +1082,38 @@ class TimelineNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> TimelineNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> TimelineNode:
+        # Local references to the methods used in the loops
+        pop = tokens.pop
+        peek = tokens.peek
+        token = pop()
         root_token = token
         if token.token_type is not TokenType.TIMELINE:
             raise ParseError.from_unexpected_token(
                 token, TokenType.TIMELINE)
-        token = tokens[0]
+        token = peek()
         # Expect indentation or finish parsing time node
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
-        elif token.token_type == TokenType.DEDENT:
-            tokens.popleft()
+        if token.token_type == _INDENT:
+            pop()
+            token = peek()
+        elif token.token_type == _DEDENT:
+            pop()
             return TimelineNode([], root_token)
         else:
             raise ParseError.from_unexpected_token(
                 token, TokenType.INDENT, TokenType.DEDENT)
         # Message nodes
         messages: list[MessageNode] = []
-        while token.token_type in (
-                TokenType.TELL, TokenType.TITLE, TokenType.BLANK,
-                TokenType.ACTIONBAR):
+        while token.token_type in MESSAGE_TOKENS:
             messages.append(MessageNode.from_token_stack(tokens))
-            token = tokens[0]
+            token = peek()
         # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
+        if token.token_type is _DEDENT:
+            pop()
         # Double dedent. This part of code is reachable only if 'timeline' has
         # subnodes
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
+        if token.token_type is _DEDENT:
+            pop()
         return TimelineNode(messages, root_token)
 
 @dataclass
@@ -970,24 +1122,16 @@ class CoordinatesNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> CoordinatesNode:
-        root_token = tokens.popleft()
-        crds_tokens = (
-            TokenType.COORDINATES_ROTATED,
-            TokenType.COORDINATES_FACING_COORDINATES,
-            TokenType.COORDINATES_FACING_ENTITY)
-        if root_token.token_type not in crds_tokens:
-            raise ParseError.from_unexpected_token(root_token, *crds_tokens)
-        any_coordinates_type = (
-            CoordinatesRotated,
-            CoordinatesFacingCoordinates,
-            CoordinatesFacingEntity)
-        if not isinstance(root_token.value, any_coordinates_type):
-            raise ParseError(
-                f"Unable to parse coordinates from line "
-                f"{root_token.line_number}")
-        coordinates = root_token.value
-        return CoordinatesNode(coordinates, root_token)
+    def from_token_stack(tokens: TokenStream) -> CoordinatesNode:
+        root_token = tokens.pop()
+        if root_token.token_type not in COORDINATES_TOKEN_SET:
+            raise ParseError.from_unexpected_token(
+                root_token, *COORDINATES_TOKENS)
+        # The type of the value is guaranteed by the tokenizer
+        assert isinstance(root_token.value, (
+            CoordinatesRotated, CoordinatesFacingCoordinates,
+            CoordinatesFacingEntity))
+        return CoordinatesNode(root_token.value, root_token)
 
 @dataclass
 class TextNode:
@@ -995,15 +1139,13 @@ class TextNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> TextNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> TextNode:
+        token = tokens.pop()
         root_token = token
-        if token.token_type is not TokenType.TEXT:
+        if token.token_type is not _TEXT:
             raise ParseError.from_unexpected_token(
                 token, TokenType.TEXT)
-        if not isinstance(token.value, str):
-            raise ParseError.from_unexpected_token_value(
-                token, "string")
+        assert isinstance(token.value, str)  # Guaranteed by the tokenizer
         return TextNode(token.value, root_token)
 
 @dataclass
@@ -1012,180 +1154,137 @@ class CommandNode:
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> CommandNode:
-        token = tokens.popleft()
+    def from_token_stack(tokens: TokenStream) -> CommandNode:
+        token = tokens.pop()
         root_token = token
-        if token.token_type is not TokenType.COMMAND:
+        if token.token_type is not _COMMAND:
             raise ParseError.from_unexpected_token(
                 token, TokenType.COMMAND)
-        if not isinstance(token.value, str):
-            raise ParseError.from_unexpected_token_value(
-                token, "string")
+        assert isinstance(token.value, str)  # Guaranteed by the tokenizer
         return CommandNode(token.value, root_token)
 
+# Shared by the command blocks without a body. The nodes only read their
+# commands, so one immutable empty sequence is enough.
+_NO_COMMANDS: tuple[CommandNode, ...] = ()
+
+def _parse_command_block(
+        tokens: TokenStream, head_type: TokenType,
+        time_settings: bool = False
+) -> tuple[Sequence[CommandNode], SettingsList, Token]:
+    '''
+    Parses a label with a block of commands, shared by the run_once,
+    schedule, on_exit and loop labels. The label is expected to have the
+    "head_type". If "time_settings" is True the label must have the "time"
+    setting (and no other settings).
+
+    Returns the command nodes, the settings and the token of the label.
+    '''
+    # Local references to the methods of the token stream
+    pop = tokens.pop
+    peek = tokens.peek
+    token = pop()
+    root_token = token
+    if token.token_type is not head_type:
+        raise ParseError.from_unexpected_token(token, head_type)
+    token = peek()
+    # Settings
+    settings: SettingsList = []
+    if time_settings:
+        if token.token_type is not _SETTING:
+            raise ParseError.from_unexpected_token(
+                token, TokenType.SETTING)
+        settings = SettingsNode.parse_settings(
+            tokens,
+            accepted_settings=TIME_SETTINGS,
+            expected_settings=TIME_SETTINGS)
+        token = peek()
+    # Expect indentation or finish parsing the node
+    if token.token_type == _INDENT:
+        pop()
+        token = peek()
+    else:
+        return _NO_COMMANDS, settings, root_token
+    # Command nodes
+    command_nodes = _drain_commands(tokens)
+    tokens.pop_block_end()
+    return command_nodes, settings, root_token
+
+def _drain_commands(tokens: TokenStream) -> list[CommandNode]:
+    '''
+    Parses all of the consecutive command tokens at the current position of
+    the stream into command nodes.
+    '''
+    return [
+        CommandNode(token.value, token)
+        for token in tokens.pop_while(_COMMAND)]
+
 @dataclass
 class RunOnceNode:
-    command_nodes: list[CommandNode]
+    command_nodes: Sequence[CommandNode]
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> RunOnceNode:
-        token = tokens.popleft()
-        root_token = token
-        if token.token_type is not TokenType.RUN_ONCE:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.RUN_ONCE)
-        # Expect indentation or finish parsing run once node
-        token = tokens[0]
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
-        else:
-            return RunOnceNode([], root_token)
-        # Command nodes
-        command_nodes = []
-        token = tokens[0]
-        while token.token_type is TokenType.COMMAND:
-            command_nodes.append(CommandNode.from_token_stack(tokens))
-            token = tokens[0]
-        # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
-        elif token.token_type is not TokenType.EOF:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.DEDENT, TokenType.EOF)
+    def from_token_stack(tokens: TokenStream) -> RunOnceNode:
+        command_nodes, _, root_token = _parse_command_block(
+            tokens, TokenType.RUN_ONCE)
         return RunOnceNode(command_nodes, root_token)
 
 @dataclass
 class ScheduleNode:
-    command_nodes: list[CommandNode]
+    command_nodes: Sequence[CommandNode]
     settings: SettingsList
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> ScheduleNode:
-        token = tokens.popleft()
-        root_token = token
-
-        if token.token_type is not TokenType.SCHEDULE:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.SCHEDULE)
-        token = tokens[0]
-        # Settings
-        settings: SettingsList = []
-        if token.token_type is not TokenType.SETTING:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.SETTING)
-        settings = SettingsNode.parse_settings(
-            tokens,
-            accepted_settings={"time": float},
-            expected_settings={"time": float})
-        token = tokens[0]
-        # Expect indentation or finish parsing schedule node
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
-        else:
-            return ScheduleNode([], [], root_token)
-        # Command nodes
-        command_nodes = []
-        token = tokens[0]
-        while token.token_type is TokenType.COMMAND:
-            command_nodes.append(CommandNode.from_token_stack(tokens))
-            token = tokens[0]
-        # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
-        elif token.token_type is not TokenType.EOF:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.DEDENT, TokenType.EOF)
+    def from_token_stack(tokens: TokenStream) -> ScheduleNode:
+        command_nodes, settings, root_token = _parse_command_block(
+            tokens, TokenType.SCHEDULE, time_settings=True)
         return ScheduleNode(command_nodes, settings, root_token)
 
 @dataclass
 class OnExitNode:
-    command_nodes: list[CommandNode]
+    command_nodes: Sequence[CommandNode]
     token: Token
-    
+
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> OnExitNode:
-        token = tokens.popleft()
-        root_token = token
-        if token.token_type is not TokenType.ON_EXIT:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.ON_EXIT)
-        token = tokens[0]
-        # Expect indentation or finish parsing on exit node
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
-        else:
-            return OnExitNode([], root_token)
-        # Command nodes
-        command_nodes = []
-        token = tokens[0]
-        while token.token_type is TokenType.COMMAND:
-            command_nodes.append(CommandNode.from_token_stack(tokens))
-            token = tokens[0]
-        # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
-        elif token.token_type is not TokenType.EOF:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.DEDENT, TokenType.EOF)
+    def from_token_stack(tokens: TokenStream) -> OnExitNode:
+        command_nodes, _, root_token = _parse_command_block(
+            tokens, TokenType.ON_EXIT)
         return OnExitNode(command_nodes, root_token)
 
 @dataclass
 class LoopNode:
-    command_nodes: list[CommandNode]
+    command_nodes: Sequence[CommandNode]
     settings: SettingsList
     token: Token
 
     @staticmethod
-    def from_token_stack(tokens: deque[Token]) -> LoopNode:
-        token = tokens.popleft()
-        root_token = token
-
-        if token.token_type is not TokenType.LOOP:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.LOOP)
-        token = tokens[0]
-        # Settings
-        settings: SettingsList = []
-        if not token.token_type is TokenType.SETTING:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.SETTING)
-        settings = SettingsNode.parse_settings(
-            tokens,
-            accepted_settings={"time": float},
-            expected_settings={"time": float})
-        token = tokens[0]
-        # Expect indentation or finish parsing run once node
-        if token.token_type == TokenType.INDENT:
-            tokens.popleft()
-            token = tokens[0]
-        else:
-            return LoopNode([], settings, root_token)
-        # Command nodes
-        command_nodes = []
-        token = tokens[0]
-        while token.token_type is TokenType.COMMAND:
-            command_nodes.append(CommandNode.from_token_stack(tokens))
-            token = tokens[0]
-        # Expect DEDENT or EOF, don't pop EOF
-        if token.token_type is TokenType.DEDENT:
-            tokens.popleft()
-        elif token.token_type is not TokenType.EOF:
-            raise ParseError.from_unexpected_token(
-                token, TokenType.DEDENT, TokenType.EOF)
+    def from_token_stack(tokens: TokenStream) -> LoopNode:
+        command_nodes, settings, root_token = _parse_command_block(
+            tokens, TokenType.LOOP, time_settings=True)
         return LoopNode(command_nodes, settings, root_token)
 
 
+# The functions that parse the nodes of the timeline by the type of their
+# first token
+TIMELINE_NODE_PARSERS: dict[
+        TokenType,
+        Callable[[TokenStream], Union[MessageNode, DialogueNode, CameraNode]]
+] = {
+    TokenType.TELL: MessageNode.from_token_stack,
+    TokenType.TITLE: MessageNode.from_token_stack,
+    TokenType.ACTIONBAR: MessageNode.from_token_stack,
+    TokenType.BLANK: MessageNode.from_token_stack,
+    TokenType.DIALOGUE: DialogueNode.from_token_stack,
+    TokenType.CAMERA: CameraNode.from_token_stack,
+}
+
 # The main AST builder function
 def build_ast(tokens: list[Token]) -> RootAstNode:
     '''
     Builds an abstract syntax tree from a list of tokens.
     '''
-    tokens_stack = deque(tokens)
+    tokens_stack = TokenStream(tokens)
     return RootAstNode.from_token_stack(tokens_stack)
 
 